@@ -27,4 +27,10 @@ def create_app():
     from .routes_mfa import mfa_bp
     app.register_blueprint(mfa_bp)
 
+    from .routes_metrics import metrics_bp
+    app.register_blueprint(metrics_bp)
+
+    from .routes_fleet import fleet_bp
+    app.register_blueprint(fleet_bp)
+
     return app
@@ -0,0 +1,223 @@
+import os
+import stat
+import fcntl
+import threading
+from types import MappingProxyType
+
+import yaml
+
+# Shared by azurednssync.py and the web app: config.yaml and smtp_auth.key are parsed once
+# and re-read only when the file's inode, mtime or size changes. Writes go to a temporary
+# file in the same directory (with the original's mode and owner) and are renamed over the
+# original, or are made in place under flock where that is not possible.
+
+CONFIG_SCHEMA = {
+    "tenant_id": str,
+    "client_id": str,
+    "subscription_id": str,
+    "certificate_path": str,
+    "certificate_password": str,
+    "resource_group": str,
+    "zone_name": str,
+    "record_set_name": str,
+    "ttl": int,
+    "email_from": str,
+    "email_to": str,
+    "smtp_server": str,
+    "smtp_port": int,
+    "smtp_username": str,
+    "zones": list,
+    "token_cache": bool,
+    "verify_interval": int,
+    "dns_resolver": (str, list),
+    "ip_providers": dict,
+    "ip_detect_mode": str,
+    "ip_quorum": int,
+    "ip_sources": list,
+    "daemon_poll_interval": int,
+    "state_db": str,
+    "run_journal": str,
+    "run_history_days": int,
+    "azure_parallelism": int,
+    "zone_snapshot": (bool, str),
+    "zone_snapshot_ttl": int,
+    "metrics_state": str,
+    "metrics_textfile": str,
+    "ipv6_prefix_length": int,
+    "change_stable_observations": int,
+    "change_stable_seconds": int,
+    "flap_window": int,
+    "flap_changes": int,
+    "flap_hold": int,
+    "azure_requests_per_second": (int, float),
+    "azure_max_retries": int,
+    "fleet_sites": dict,
+    "fleet_workers": int,
+    "fleet_zone_writes_per_second": (int, float),
+    "fleet_controller": str,
+    "fleet_site": str,
+    "fleet_token": str,
+    "fleet_ca_file": str,
+}
+
+class ConfigError(ValueError):
+    pass
+
+def validate_config(config, schema=CONFIG_SCHEMA):
+    # Returns a copy with ints and bools coerced from strings (as the web forms send them).
+    # Unknown keys are kept as they are.
+    if not isinstance(config, dict):
+        raise ConfigError("config must be a mapping")
+    validated = dict(config)
+    errors = []
+    for key, expected in schema.items():
+        if key not in validated or validated[key] is None:
+            continue
+        value = validated[key]
+        if expected is int and isinstance(value, str):
+            try:
+                value = int(value.strip())
+            except ValueError:
+                errors.append(f"{key}: expected a number, got {value!r}")
+                continue
+        elif expected is bool and isinstance(value, str):
+            if value.strip().lower() not in ("true", "false", "yes", "no", "1", "0"):
+                errors.append(f"{key}: expected true or false, got {value!r}")
+                continue
+            value = value.strip().lower() in ("true", "yes", "1")
+        if isinstance(value, bool) and expected is int:
+            errors.append(f"{key}: expected a number, got {value!r}")
+            continue
+        if not isinstance(value, expected):
+            errors.append(f"{key}: unexpected value {value!r}")
+            continue
+        validated[key] = value
+    if errors:
+        raise ConfigError("; ".join(errors))
+    return validated
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def write_file_in_place(path, data):
+    # For files whose directory the writer may not create files in (e.g. a group-writable
+    # config.yaml in a root-owned /etc directory). Readers take the shared lock.
+    with open(path, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.truncate()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_file_atomic(path, data, mode=0o600):
+    # A replaced file keeps the original's mode, owner and group; when the directory is not
+    # writable, or the owner cannot be kept, it is rewritten in place instead.
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    directory = os.path.dirname(os.path.abspath(path))
+    if st is not None and not os.access(directory, os.W_OK):
+        return write_file_in_place(path, data)
+    tmp_path = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, "w") as f:
+            if st is not None:
+                os.fchmod(f.fileno(), stat.S_IMODE(st.st_mode))
+                if (st.st_uid, st.st_gid) != (os.geteuid(), os.getegid()):
+                    os.fchown(f.fileno(), st.st_uid, st.st_gid)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except PermissionError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if st is None:
+            raise
+        write_file_in_place(path, data)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class CachedFile:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._value = None
+
+    def _parse(self, text):
+        raise NotImplementedError
+
+    def _load(self):
+        # Parsed value, re-read only when the file has changed on disk.
+        signature = file_signature(self.path)
+        with self._lock:
+            if signature != self._signature:
+                if signature is None:
+                    self._value = None
+                else:
+                    with open(self.path, "r") as f:
+                        fcntl.flock(f, fcntl.LOCK_SH)
+                        self._value = self._parse(f.read())
+                self._signature = signature
+            return self._value
+
+    def exists(self):
+        return file_signature(self.path) is not None
+
+    def _store(self, text, value):
+        with self._lock:
+            write_file_atomic(self.path, text)
+            self._signature = file_signature(self.path)
+            self._value = value
+
+class ConfigStore(CachedFile):
+    def __init__(self, path, defaults=None, schema=CONFIG_SCHEMA):
+        super().__init__(path)
+        self.defaults = dict(defaults or {})
+        self.schema = schema
+
+    def _parse(self, text):
+        return MappingProxyType(validate_config({**self.defaults, **(yaml.safe_load(text) or {})}, self.schema))
+
+    def snapshot(self):
+        # Read-only view of the current config with defaults filled in, or None if there
+        # is no config file. The same object is returned until the file changes.
+        return self._load()
+
+    def write(self, config):
+        validated = validate_config(config, self.schema)
+        self._store(yaml.safe_dump(validated, default_flow_style=False), MappingProxyType({**self.defaults, **validated}))
+
+    def update(self, changes):
+        current = {}
+        if self.exists():
+            with open(self.path, "r") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                current = yaml.safe_load(f) or {}
+        current.update(changes)
+        self.write(current)
+
+class SmtpKeyStore(CachedFile):
+    def _parse(self, text):
+        username = password = None
+        for line in text.splitlines():
+            if line.startswith("username:"):
+                username = line.split(":", 1)[1].strip()
+            elif line.startswith("password:"):
+                password = line.split(":", 1)[1].strip()
+        return username, password
+
+    def read(self):
+        return self._load() or (None, None)
+
+    def write(self, username, password):
+        self._store(f"username:{username}\npassword:{password}\n", (username, password))
@@ -0,0 +1,191 @@
+import time
+import hmac
+import hashlib
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .sync_jobs import load_sync_module
+    from .request_policy import TokenBucket
+except ImportError:  # run.py imports the blueprints as top-level modules
+    from sync_jobs import load_sync_module
+    from request_policy import TokenBucket
+
+# Fleet mode: edge sites only detect their public IPs and report them here; this process
+# holds the Azure credentials and does the writes. Reports are collapsed per record set
+# (only the latest IP waiting for a record is written, and a report of the IP already in
+# Azure costs nothing until it is "verify_interval" seconds old), and the writes run on a worker pool with a token bucket per zone
+# ("fleet_zone_writes_per_second", default 5; "fleet_workers", default 8).
+#
+# Sites are listed under "fleet_sites" in the controller's config.yaml:
+#
+#     fleet_sites:
+#       branch-042:
+#         token_sha256: 9f86d081...     # sha256 of the site's bearer token
+#         zones:                        # same shape as the top-level "zones"
+#           - zone_name: example.com
+#             record_sets: [branch-042]
+
+FLEET_WORKERS = 8
+FLEET_ZONE_WRITES_PER_SECOND = 5
+
+class FleetAuthError(Exception):
+    pass
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class FleetController:
+    def __init__(self, sync=None):
+        self._sync = sync
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = {}     # record key -> (record, ip, site), the latest report not yet written
+        self._in_flight = set()
+        self._known = {}       # record key -> (IP last seen in Azure, when it was seen)
+        self._buckets = {}
+        self._targets = {}
+        self._targets_config = None
+        self._state = {"records": {}}
+        self.stats = {"reports": 0, "unchanged": 0, "collapsed": 0, "written": 0, "failed": 0}
+
+    def sync(self):
+        if self._sync is None:
+            self._sync = load_sync_module()
+        return self._sync
+
+    def config(self):
+        # An unreadable or invalid config.yaml is the controller's problem, not the site's:
+        # it surfaces as RuntimeError, which the report route answers with 503.
+        try:
+            config = self.sync().config_store.snapshot()
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"The controller's configuration cannot be read: {e}") from e
+        if config is None:
+            raise RuntimeError("The controller has no configuration.")
+        return config
+
+    def site_targets(self, config, site, token):
+        # The site's records, after checking its bearer token against fleet_sites.
+        spec = (config.get("fleet_sites") or {}).get(site)
+        if not spec or not token or not hmac.compare_digest(str(spec.get("token_sha256", "")), hash_token(token)):
+            raise FleetAuthError(f"Unknown site or bad token: {site}")
+        with self._lock:
+            # Record targets are rebuilt only when config.yaml changes (a new snapshot).
+            if config is not self._targets_config:
+                self._targets = {}
+                self._targets_config = config
+            targets = self._targets.get(site)
+        if targets is None:
+            site_config = dict(config, zones=spec.get("zones") or [], zone_name="", record_set_name="")
+            targets = self.sync().get_record_targets(site_config)
+            with self._lock:
+                self._targets[site] = targets
+        return targets
+
+    def _start(self, config):
+        with self._lock:
+            if self._executor is None:
+                workers = int(config.get("fleet_workers", FLEET_WORKERS))
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fleet")
+                sync = self.sync()
+                if sync._mail_worker is None:
+                    sync._mail_worker = sync.MailWorker(config)
+                    sync._mail_worker.start()
+            return self._executor
+
+    def _is_known(self, key, ip, config):
+        # True while Azure was last seen holding ip less than verify_interval seconds ago;
+        # after that a report re-reads the record, so changes made in Azure get repaired.
+        known = self._known.get(key)
+        return known is not None and known[0] == ip and time.time() - known[1] < config.get("verify_interval", 3600)
+
+    def report(self, site, token, ips):
+        # Queues a write for every record of the site whose reported IP differs from what
+        # Azure holds. Returns the number of records queued.
+        config = self.config()
+        targets = self.site_targets(config, site, token)
+        sync = self.sync()
+        queued = []
+        with self._lock:
+            for record in targets:
+                reported = ips.get(record["record_type"])
+                if not reported or not sync.is_public_address(reported, record["record_type"]):
+                    continue
+                ip = sync.record_target_ip(record, {record["record_type"]: reported})
+                key = sync.record_state_key(record)
+                self.stats["reports"] += 1
+                if key not in self._pending and self._is_known(key, ip, config):
+                    self.stats["unchanged"] += 1
+                    continue
+                if key in self._pending:
+                    self.stats["collapsed"] += 1
+                self._pending[key] = (record, ip, site, config)
+                if key not in self._in_flight:
+                    self._in_flight.add(key)
+                    queued.append(key)
+        if queued:
+            executor = self._start(config)
+            for key in queued:
+                executor.submit(self._write, key)
+        return len(queued)
+
+    def _bucket(self, config, record):
+        key = (record["resource_group"].lower(), record["zone_name"].lower())
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(config.get("fleet_zone_writes_per_second", FLEET_ZONE_WRITES_PER_SECOND))
+                self._buckets[key] = bucket
+            return bucket
+
+    def _write(self, key):
+        # One worker per record at a time; reports that arrive while it is writing replace
+        # the pending IP and are picked up by the same worker afterwards.
+        sync = self.sync()
+        while True:
+            with self._lock:
+                item = self._pending.pop(key, None)
+                if item is None:
+                    self._in_flight.discard(key)
+                    return
+                record, ip, site, config = item
+                if self._is_known(key, ip, config):
+                    self.stats["unchanged"] += 1
+                    continue
+            try:
+                result = self._apply(sync, config, record, ip, site)
+            except Exception as e:
+                sync.log_update(f"{datetime.now()}: Fleet update for {record['fqdn']} from {site} failed: {e}")
+                result = False
+            with self._lock:
+                if result is False:
+                    self.stats["failed"] += 1
+                    self._known.pop(key, None)
+                else:
+                    self._known[key] = (ip, time.time())
+                    if result:
+                        self.stats["written"] += 1
+
+    def _apply(self, sync, config, record, ip, site):
+        dns_client = sync.get_dns_client(config)
+        record_set = sync.fetch_record_set(dns_client, record, config)
+        azure_ip = sync.record_set_ip(record_set, record["record_type"]) if record_set else None
+        if azure_ip == ip:
+            return None
+        change = {"record": record, "public_ip": ip, "record_set": record_set, "azure_ip": azure_ip}
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._bucket(config, record).acquire()
+        result = sync.apply_record_change(change, config, dns_client, now, self._state)
+        if result:
+            # Spooled without waking the mail worker, so its next pass (at most a minute
+            # away) sends every fleet update since the last one as a single digest.
+            sync.spool_email(f"Azure DNS Updated: {record['fqdn']}", f"{result} (reported by {site})")
+        return result
+
+    def status(self):
+        with self._lock:
+            return dict(self.stats, pending=len(self._pending), in_flight=len(self._in_flight))
+
+controller = FleetController()
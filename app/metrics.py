@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Prometheus metrics for azurednssync.py, shared with the web app's /metrics endpoint.
+# Each process records into a MetricsRegistry and flush() merges that into a JSON state
+# file under an flock, so one-shot timer runs, the mail drainer and the daemon all add to
+# the same counters and histograms. The state can then be rendered as Prometheus text.
+
+# Where an installed sync writes its state and the web app reads it from.
+DEFAULT_STATE_PATH = "/var/lib/azurednssync2/metrics_state.json"
+
+PHASE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    "azurednssync_phase_duration_seconds": ("histogram", "Time spent in each phase of a sync."),
+    "azurednssync_api_calls_total": ("counter", "Calls to upstream services."),
+    "azurednssync_api_errors_total": ("counter", "Failed calls to upstream services."),
+    "azurednssync_sync_runs_total": ("counter", "Sync runs by outcome."),
+    "azurednssync_last_run_timestamp_seconds": ("gauge", "Start time of the last sync run."),
+    "azurednssync_last_success_timestamp_seconds": ("gauge", "Start time of the last sync that did not fail."),
+    "azurednssync_last_success_age_seconds": ("gauge", "Seconds since the last sync that did not fail."),
+    "azurednssync_azure_throttled_total": ("counter", "Azure calls answered with 429 Too Many Requests."),
+    "azurednssync_azure_retries_total": ("counter", "Azure calls retried after a transient failure."),
+    "azurednssync_azure_circuit_opened_total": ("counter", "Times the Azure circuit breaker opened."),
+    "azurednssync_azure_short_circuited_total": ("counter", "Azure calls skipped while the circuit was open."),
+}
+
+def label_key(labels):
+    return ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = f"{name}|{label_key(labels)}"
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[f"{name}|{label_key(labels)}"] = value
+
+    def observe(self, name, value, **labels):
+        key = f"{name}|{label_key(labels)}"
+        with self._lock:
+            histogram = self.histograms.setdefault(key, {"buckets": [0] * len(PHASE_BUCKETS), "sum": 0, "count": 0})
+            for i, bound in enumerate(PHASE_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def timer(self, phase):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe("azurednssync_phase_duration_seconds", time.monotonic() - started, phase=phase)
+
+    @contextmanager
+    def track(self, api, phase=None):
+        # Counts one call to api (and an error if the block raises), timing it as phase.
+        started = time.monotonic()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if phase:
+                self.observe("azurednssync_phase_duration_seconds", time.monotonic() - started, phase=phase)
+            self.call(api, error)
+
+    def call(self, api, error=None):
+        self.inc("azurednssync_api_calls_total", api=api)
+        if error is not None:
+            self.inc("azurednssync_api_errors_total", api=api)
+
+    def flush(self, state_path, textfile_path=None):
+        # Adds everything recorded since the last flush to the state file and rewrites the
+        # textfile-collector file from the merged state.
+        import fcntl
+        with self._lock:
+            counters, gauges, histograms = self.counters, self.gauges, self.histograms
+            self._reset()
+        with open(state_path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = load_state(state_path)
+            for key, value in counters.items():
+                state["counters"][key] = state["counters"].get(key, 0) + value
+            state["gauges"].update(gauges)
+            for key, histogram in histograms.items():
+                merged = state["histograms"].setdefault(key, {"buckets": [0] * len(PHASE_BUCKETS), "sum": 0, "count": 0})
+                merged["buckets"] = [a + b for a, b in zip(merged["buckets"], histogram["buckets"])]
+                merged["sum"] += histogram["sum"]
+                merged["count"] += histogram["count"]
+            write_atomic(state_path, json.dumps(state))
+            if textfile_path:
+                write_atomic(textfile_path, render(state))
+
+def load_state(path):
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    for section in ("counters", "gauges", "histograms"):
+        state.setdefault(section, {})
+    return state
+
+def write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def render(state, now=None):
+    # Prometheus text exposition format. The success age is computed at render time, so
+    # /metrics reports it live; in the textfile it is as of the last flush.
+    samples = {}
+    for key, value in state["counters"].items():
+        name, labels = key.split("|", 1)
+        samples.setdefault(name, []).append((labels, value))
+    for key, value in state["gauges"].items():
+        name, labels = key.split("|", 1)
+        samples.setdefault(name, []).append((labels, value))
+    last_success = state["gauges"].get("azurednssync_last_success_timestamp_seconds|")
+    if last_success is not None:
+        samples["azurednssync_last_success_age_seconds"] = [("", round((now or time.time()) - last_success, 3))]
+    lines = []
+    for name in sorted(samples):
+        kind, help_text = HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(samples[name]):
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    histograms = {}
+    for key, histogram in state["histograms"].items():
+        name, labels = key.split("|", 1)
+        histograms.setdefault(name, []).append((labels, histogram))
+    for name in sorted(histograms):
+        kind, help_text = HELP.get(name, ("histogram", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in sorted(histograms[name], key=lambda item: item[0]):
+            prefix = f"{labels}," if labels else ""
+            for bound, count in zip(PHASE_BUCKETS, histogram["buckets"]):
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram["count"]}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{suffix} {round(histogram['sum'], 6)}")
+            lines.append(f"{name}_count{suffix} {histogram['count']}")
+    return "\n".join(lines) + "\n"
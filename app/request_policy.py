@@ -0,0 +1,160 @@
+import time
+import random
+import threading
+
+# Request policy for Azure Resource Manager calls, shared by azurednssync.py and the fleet
+# controller: a token bucket per subscription, jittered exponential backoff that honours
+# Retry-After, and a circuit breaker that fails calls fast while ARM keeps failing. A 429
+# halves the bucket's rate; each success wins back a little of it.
+
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+# Connection-level failures from azure-core and requests, matched by name so this module
+# does not have to import either.
+TRANSIENT_ERRORS = ("ServiceRequestError", "ServiceResponseError", "ConnectionError", "Timeout", "ConnectTimeout", "ReadTimeout")
+
+class CircuitOpenError(Exception):
+    def __init__(self, open_until):
+        super().__init__(f"Azure circuit open until {time.strftime('%H:%M:%S', time.localtime(open_until))}")
+        self.open_until = open_until
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        # rate <= 0 disables the limit.
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until a token is available.
+        while self.rate > 0:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive failed calls, for `cooldown` seconds; the first
+    # call after that is let through, and one more failure opens it again. Times are wall
+    # clock so the state can be saved between one-shot runs (dump/load).
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return time.time() >= self.open_until
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.open_until = 0
+
+    def failure(self, hold=None):
+        # Returns True if this failure opened the circuit. hold (e.g. a long Retry-After)
+        # opens it at once for at least that long.
+        with self._lock:
+            self.failures += 1
+            if self.failures < self.threshold and not hold:
+                return False
+            was_open = not self.allow()
+            self.open_until = time.time() + max(hold or 0, self.cooldown if self.failures >= self.threshold else 0)
+            return not was_open
+
+    def dump(self):
+        with self._lock:
+            return {"failures": self.failures, "open_until": self.open_until}
+
+    def load(self, saved):
+        # Adopts saved state from an earlier run unless this process has seen newer.
+        if not saved:
+            return
+        with self._lock:
+            if saved.get("open_until", 0) > self.open_until or (not self.open_until and saved.get("failures", 0) > self.failures):
+                self.failures = saved.get("failures", 0)
+                self.open_until = saved.get("open_until", 0)
+
+def is_transient(error):
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return isinstance(error, (TimeoutError, ConnectionError)) or type(error).__name__ in TRANSIENT_ERRORS
+
+def retry_after(error):
+    # Seconds from a Retry-After header (delta or HTTP date), or None.
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+class RequestPolicy:
+    def __init__(self, rate, burst, max_retries, backoff_base, backoff_max, breaker, metrics=None):
+        self.configured_rate = float(rate)
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker
+        self.metrics = metrics
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.inc(name)
+
+    def _throttled(self):
+        self._count("azurednssync_azure_throttled_total")
+        if self.bucket.rate > 0:
+            self.bucket.rate = max(self.configured_rate / 16, self.bucket.rate / 2)
+
+    def _recovered(self):
+        if 0 < self.bucket.rate < self.configured_rate:
+            self.bucket.rate = min(self.configured_rate, self.bucket.rate + self.configured_rate / 20)
+
+    def call(self, fn):
+        # Runs fn() under the policy. Errors that ARM answered deliberately (404, 412, ...)
+        # are raised at once and count as the service being up.
+        if not self.breaker.allow():
+            self._count("azurednssync_azure_short_circuited_total")
+            raise CircuitOpenError(self.breaker.open_until)
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_transient(e):
+                    if getattr(e, "status_code", None) is not None:
+                        self.breaker.success()
+                    raise
+                if getattr(e, "status_code", None) == 429:
+                    self._throttled()
+                delay = retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                if attempt >= self.max_retries or delay > self.backoff_max:
+                    if self.breaker.failure(hold=delay if delay > self.backoff_max else None):
+                        self._count("azurednssync_azure_circuit_opened_total")
+                    raise
+                self._count("azurednssync_azure_retries_total")
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self.breaker.success()
+            self._recovered()
+            return result
@@ -1,33 +1,45 @@
 from flask import Blueprint, render_template, request, redirect, flash, url_for
-import yaml
-import os
+
+try:
+    from .config_store import ConfigStore, ConfigError
+except ImportError:  # run.py imports the blueprints as top-level modules
+    from config_store import ConfigStore, ConfigError
 
 config_bp = Blueprint('config', __name__)
 
 CONFIG_PATH = "/etc/azurednssync2/config.yaml"
+config_store = ConfigStore(CONFIG_PATH)
+
+def form_fields(config):
+    # The form edits one text field per key, so lists and mappings (zones, ip_providers,
+    # ip_sources, fleet_sites, ...) are left out of it and are edited in config.yaml.
+    return {key: value for key, value in config.items() if not isinstance(value, (dict, list))}
 
 @config_bp.route("/view-config")
 def view_config():
-    config = {}
-    if os.path.exists(CONFIG_PATH):
-        with open(CONFIG_PATH) as f:
-            config = yaml.safe_load(f)
+    try:
+        config = config_store.snapshot() or {}
+    except (OSError, ValueError) as e:
+        flash(f"Failed to read config: {e}", "danger")
+        config = {}
     return render_template("view_config.html", config=config)
 
 @config_bp.route("/update-config", methods=["GET", "POST"])
 def update_config():
-    config = {}
-    if os.path.exists(CONFIG_PATH):
-        with open(CONFIG_PATH) as f:
-            config = yaml.safe_load(f)
+    try:
+        config = dict(config_store.snapshot() or {})
+    except (OSError, ValueError) as e:
+        flash(f"Failed to read config: {e}", "danger")
+        config = {}
+    fields = form_fields(config)
     if request.method == "POST":
-        for key in config.keys():
-            config[key] = request.form.get(key, config[key])
+        changes = {key: request.form[key] for key in fields if key in request.form}
         try:
-            with open(CONFIG_PATH, "w") as f:
-                yaml.safe_dump(config, f)
+            config_store.update(changes)
             flash("Config updated.", "success")
             return redirect(url_for("config.view_config"))
+        except ConfigError as e:
+            flash(f"Invalid config: {e}", "danger")
         except Exception as e:
             flash(f"Failed to update config: {e}", "danger")
-    return render_template("update_config.html", config=config)
+    return render_template("update_config.html", config=fields)
@@ -1,6 +1,17 @@
 import os
+import sqlite3
 import subprocess
-from flask import Blueprint, render_template, send_file, flash, redirect, url_for, request
+from datetime import datetime
+from flask import Blueprint, render_template, send_file, flash, redirect, url_for, request, jsonify
+
+try:
+    from .state_store import StateStore, OUTCOMES, DEFAULT_PATH as STATE_DB_PATH
+    from .sync_jobs import submit_sync_job, get_job
+    from .service_state import ServiceStateProvider
+except ImportError:  # run.py imports the blueprints as top-level modules
+    from state_store import StateStore, OUTCOMES, DEFAULT_PATH as STATE_DB_PATH
+    from sync_jobs import submit_sync_job, get_job
+    from service_state import ServiceStateProvider
 
 dashboard_bp = Blueprint("dashboard", __name__, url_prefix="/dashboard")
 
@@ -8,34 +19,45 @@ SERVICE_NAME = "azurednssync2"
 SYSTEMCTL_PATH = "/usr/bin/systemctl"
 CERT_PATH = "/var/lib/azurednssync2/certs/cert.pem"
 CONFIG_PATH = "/etc/azurednssync2/config.yaml"
-SYNC_LOG_PATH = "/var/log/azurednssync2/sync.log"
+RUNS_PER_PAGE = 20
+SERVICE_STATE_TTL = 5
+SERVICE_STATE_MAX_WAIT = 25
+
+service_state = ServiceStateProvider(SERVICE_NAME, SYSTEMCTL_PATH, ttl=SERVICE_STATE_TTL)
+state_store = StateStore(STATE_DB_PATH)
 
 def get_service_status():
+    return service_state.get_status_text()
+
+def describe_service_state(state):
+    if "error" in state:
+        return f"Unknown ({state['error']})"
+    return f"{state.get('ActiveState', 'unknown')} ({state.get('SubState', 'unknown')})"
+
+def parse_time_arg(value):
+    if not value:
+        return None
     try:
-        output = subprocess.check_output(
-            [SYSTEMCTL_PATH, "status", SERVICE_NAME],
-            stderr=subprocess.STDOUT
-        )
-        return output.decode()
-    except FileNotFoundError:
-        return "Error: systemctl not found on this system."
-    except subprocess.CalledProcessError as e:
-        return f"Service status error: {e.output.decode()}"
-    except Exception as e:
-        return f"Unexpected error retrieving service status: {str(e)}"
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
 
-def run_sync():
-    # Example: Replace with your actual sync command or logic
-    # Could be a Python function or a subprocess call
+def query_runs(args):
+    page = max(1, args.get("page", 1, type=int))
+    outcome = args.get("outcome") if args.get("outcome") in OUTCOMES else None
     try:
-        # Here you should put the actual sync logic for your app.
-        # For now, just log a message.
-        import datetime
-        with open(SYNC_LOG_PATH, "a") as f:
-            f.write("Sync run at {}\n".format(str(datetime.datetime.now())))
-        return True, "Sync executed."
-    except Exception as e:
-        return False, f"Error running sync: {str(e)}"
+        runs, more = state_store.query_runs(
+            limit=RUNS_PER_PAGE,
+            offset=(page - 1) * RUNS_PER_PAGE,
+            outcome=outcome,
+            since=parse_time_arg(args.get("since")),
+            until=parse_time_arg(args.get("until")),
+        )
+    except sqlite3.Error:
+        runs, more = [], False
+    for run in runs:
+        run["started"] = datetime.fromtimestamp(run["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+    return runs, page, more
 
 def restart_service():
     try:
@@ -56,27 +78,74 @@ def dashboard():
     # Handle button POSTs for sync or restart
     if request.method == "POST":
         if "run_sync" in request.form:
-            success, sync_message = run_sync()
-            flash(sync_message, "success" if success else "danger")
+            flash_sync_job(*submit_sync_job())
         elif "restart_service" in request.form:
             success, restart_message = restart_service()
+            service_state.invalidate()
             flash(restart_message, "success" if success else "danger")
         return redirect(url_for("dashboard.dashboard"))
 
-    service_status = get_service_status()
-
-    if os.path.isfile(SYNC_LOG_PATH):
-        with open(SYNC_LOG_PATH, "r") as f:
-            last_sync_log = f.read()
-    else:
-        last_sync_log = "No log found."
+    service_version, state = service_state.get_state()
+    runs, page, more = query_runs(request.args)
+    try:
+        latest = state_store.latest_run()
+    except sqlite3.Error:
+        latest = None
+    status = {
+        "last_run": datetime.fromtimestamp(latest["timestamp"]).strftime("%Y-%m-%d %H:%M:%S") if latest else "Never",
+        "result": (latest["error"] or latest["outcome"]) if latest else "No runs recorded.",
+    }
 
     return render_template(
         "dashboard.html",
-        service_status=service_status,
-        last_sync_log=last_sync_log
+        service_state=describe_service_state(state),
+        service_version=service_version,
+        status=status,
+        runs=runs,
+        page=page,
+        more=more,
+        outcomes=OUTCOMES,
+        outcome=request.args.get("outcome", "")
     )
 
+def flash_sync_job(job, created):
+    if created:
+        flash(f"Sync job {job['id']} started.", "success")
+    else:
+        flash(f"Sync job {job['id']} is already {job['status']}.", "info")
+
+@dashboard_bp.route("/run_now", methods=["GET", "POST"])
+def run_now():
+    job, created = submit_sync_job()
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(job=job, created=created), 202
+    flash_sync_job(job, created)
+    return redirect(url_for("dashboard.dashboard"))
+
+@dashboard_bp.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify(error="unknown job"), 404
+    return jsonify(job=job)
+
+@dashboard_bp.route("/runs")
+def runs():
+    runs, page, more = query_runs(request.args)
+    return jsonify(runs=runs, page=page, more=more)
+
+@dashboard_bp.route("/service_state")
+def service_state_poll():
+    # Long poll: with ?since=<version>, holds the request until the unit state changes
+    # (or up to SERVICE_STATE_MAX_WAIT seconds) instead of having the page re-poll.
+    since = request.args.get("since", type=int)
+    if since is None:
+        version, state = service_state.get_state()
+    else:
+        wait = min(max(0, request.args.get("wait", SERVICE_STATE_MAX_WAIT, type=int)), SERVICE_STATE_MAX_WAIT)
+        version, state = service_state.wait_for_change(since, wait)
+    return jsonify(version=version, state=state, summary=describe_service_state(state))
+
 @dashboard_bp.route("/download_cert")
 def download_cert():
     if not os.path.isfile(CERT_PATH):
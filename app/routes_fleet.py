@@ -0,0 +1,37 @@
+from flask import Blueprint, request, jsonify
+
+try:
+    from .fleet import controller, FleetAuthError
+except ImportError:  # run.py imports the blueprints as top-level modules
+    from fleet import controller, FleetAuthError
+
+fleet_bp = Blueprint("fleet", __name__, url_prefix="/fleet")
+
+MAX_REPORT_BYTES = 4096
+
+@fleet_bp.route("/report", methods=["POST"])
+def fleet_report():
+    # Called by edge agents, authenticated with their own bearer token rather than a
+    # dashboard session: {"site": "branch-042", "ips": {"A": "203.0.113.7"}}
+    if (request.content_length or 0) > MAX_REPORT_BYTES:
+        return jsonify(error="report too large"), 413
+    report = request.get_json(silent=True) or {}
+    auth = request.headers.get("Authorization", "")
+    token = auth[len("Bearer "):] if auth.startswith("Bearer ") else None
+    ips = report.get("ips")
+    if (
+        not isinstance(report.get("site"), str) or not isinstance(ips, dict)
+        or not all(isinstance(ip, str) for ip in ips.values())
+    ):
+        return jsonify(error="expected {\"site\": ..., \"ips\": {...}}"), 400
+    try:
+        queued = controller.report(report["site"], token, ips)
+    except FleetAuthError:
+        return jsonify(error="unauthorized"), 401
+    except RuntimeError as e:
+        return jsonify(error=str(e)), 503
+    return jsonify(queued=queued), 202
+
+@fleet_bp.route("/status")
+def fleet_status():
+    return jsonify(controller.status())
@@ -0,0 +1,23 @@
+import os
+import hmac
+from flask import Blueprint, Response, request
+
+try:
+    from .metrics import load_state, render, DEFAULT_STATE_PATH
+except ImportError:  # run.py imports the blueprints as top-level modules
+    from metrics import load_state, render, DEFAULT_STATE_PATH
+
+metrics_bp = Blueprint("metrics", __name__)
+
+METRICS_STATE_PATH = DEFAULT_STATE_PATH
+# Scrapers skip the login flow (run.py); set METRICS_SCRAPE_TOKEN to require
+# "Authorization: Bearer <token>" instead.
+METRICS_SCRAPE_TOKEN = os.environ.get("METRICS_SCRAPE_TOKEN")
+
+@metrics_bp.route("/metrics")
+def metrics():
+    if METRICS_SCRAPE_TOKEN:
+        auth = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(auth.encode(), f"Bearer {METRICS_SCRAPE_TOKEN}".encode()):
+            return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(render(load_state(METRICS_STATE_PATH)), mimetype="text/plain; version=0.0.4")
@@ -1,14 +1,19 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
-import os
-import yaml
+
+try:
+    from .config_store import ConfigStore, SmtpKeyStore, ConfigError
+except ImportError:  # run.py imports the blueprints as top-level modules
+    from config_store import ConfigStore, SmtpKeyStore, ConfigError
 
 setup_bp = Blueprint('setup', __name__, template_folder='templates')
 
 CONFIG_PATH = "/etc/azurednssync2/config.yaml"
 SMTP_KEY_PATH = "/etc/azurednssync2/smtp_auth.key"
+config_store = ConfigStore(CONFIG_PATH)
+smtp_key_store = SmtpKeyStore(SMTP_KEY_PATH)
 
 def is_configured():
-    return os.path.exists(CONFIG_PATH)
+    return config_store.exists()
 
 @setup_bp.route("/setup", methods=["GET", "POST"])
 def setup():
@@ -57,17 +62,16 @@ def setup():
         }
 
         try:
-            with open(CONFIG_PATH, "w") as f:
-                yaml.safe_dump(config, f, default_flow_style=False)
-            os.chmod(CONFIG_PATH, 0o600)
+            config_store.write(config)
+        except ConfigError as e:
+            flash(f"Invalid configuration: {e}", "danger")
+            return render_template("setup.html")
         except Exception as e:
             flash(f"Failed to write config.yaml: {e}", "danger")
             return render_template("setup.html")
 
         try:
-            with open(SMTP_KEY_PATH, "w") as f:
-                f.write(f"username:{smtp_username}\npassword:{smtp_password}\n")
-            os.chmod(SMTP_KEY_PATH, 0o600)
+            smtp_key_store.write(smtp_username, smtp_password)
         except Exception as e:
             flash(f"Failed to write SMTP credentials: {e}", "danger")
             return render_template("setup.html")
@@ -8,6 +8,8 @@ from pam import pam
 from routes_setup import setup_bp, is_configured
 from user_mfa import load_mfa_data, save_mfa_data
 from routes_dashboard import dashboard_bp  # Import your dashboard blueprint
+from routes_metrics import metrics_bp
+from routes_fleet import fleet_bp
 
 USER_MFA = load_mfa_data()  # Persistent MFA data
 
@@ -16,6 +18,8 @@ app.secret_key = secrets.token_hex(32)
 
 app.register_blueprint(setup_bp)
 app.register_blueprint(dashboard_bp)
+app.register_blueprint(metrics_bp)
+app.register_blueprint(fleet_bp)
 
 @app.route("/")
 def index():
@@ -116,7 +120,7 @@ def download_cert():
 @app.before_request
 def enforce_user_flow():
     allowed_endpoints = {
-        "login", "static", "favicon"
+        "login", "static", "favicon", "fleet_report", "metrics"
     }
     endpoint = (request.endpoint or "").split('.')[-1]
     if endpoint in allowed_endpoints:
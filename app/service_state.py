@@ -0,0 +1,116 @@
+import time
+import threading
+import subprocess
+
+# Cached systemd unit state for the dashboard. Page loads read the cache; a background
+# poller refreshes it with "systemctl show" every `ttl` seconds while pages are being
+# served, and goes idle when nobody has asked for `idle_after` seconds. Long-poll clients
+# wait on the state version and wake as soon as the poller sees a change.
+
+SHOW_PROPERTIES = ("LoadState", "ActiveState", "SubState", "MainPID", "ActiveEnterTimestamp", "ExecMainStatus")
+
+class ServiceStateProvider:
+    def __init__(self, unit, systemctl_path, ttl=5, idle_after=60):
+        self.unit = unit
+        self.systemctl_path = systemctl_path
+        self.ttl = ttl
+        self.idle_after = idle_after
+        self._changed = threading.Condition()
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._state = None
+        self._version = 0
+        self._fetched_at = 0
+        self._last_request = 0
+        self._status_text = None
+        self._status_fetched_at = 0
+        self._poller = None
+        self._idle = True
+
+    def _systemctl(self, *args):
+        try:
+            output = subprocess.check_output(
+                [self.systemctl_path, *args, self.unit, "--no-pager"],
+                stderr=subprocess.STDOUT,
+                timeout=5,
+            )
+            return output.decode()
+        except FileNotFoundError:
+            raise RuntimeError("systemctl not found on this system.")
+        except subprocess.CalledProcessError as e:
+            # "systemctl status" exits non-zero for inactive units but still prints them.
+            return e.output.decode()
+
+    def _refresh(self):
+        try:
+            output = self._systemctl("show", "--property=" + ",".join(SHOW_PROPERTIES))
+            state = dict(line.split("=", 1) for line in output.splitlines() if "=" in line)
+        except Exception as e:
+            state = {"error": str(e)}
+        with self._changed:
+            self._fetched_at = time.monotonic()
+            if state != self._state:
+                self._state = state
+                self._version += 1
+                self._changed.notify_all()
+
+    def _refresh_if_stale(self, max_age):
+        # Concurrent callers share one systemctl run.
+        with self._refresh_lock:
+            if time.monotonic() - self._fetched_at > max_age:
+                self._refresh()
+
+    def _touch(self):
+        self._last_request = time.monotonic()
+        if self._poller is None or not self._poller.is_alive():
+            self._poller = threading.Thread(target=self._poll, name="service-state", daemon=True)
+            self._poller.start()
+        if self._idle:
+            self._wake.set()
+
+    def _poll(self):
+        while True:
+            self._idle = time.monotonic() - self._last_request > self.idle_after
+            self._wake.wait(None if self._idle else self.ttl)
+            self._wake.clear()
+            self._idle = False
+            self._refresh_if_stale(self.ttl / 2)
+
+    def invalidate(self):
+        # Called after the dashboard changes the unit (e.g. a restart) so the next read
+        # and any long-poll waiters see the new state without waiting out the TTL.
+        self._fetched_at = 0
+        self._status_fetched_at = 0
+        self._wake.set()
+
+    def get_state(self):
+        # (version, state). Served from the cache while the poller is running; only the
+        # first request after an idle period runs systemctl itself.
+        self._touch()
+        self._refresh_if_stale(self.ttl)
+        with self._changed:
+            return self._version, dict(self._state or {})
+
+    def wait_for_change(self, version, timeout):
+        # Long poll: returns as soon as the state version differs from `version`.
+        self._touch()
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while self._version == version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+                self._last_request = time.monotonic()
+            return self._version, dict(self._state or {})
+
+    def get_status_text(self):
+        # Full "systemctl status" output, cached for the same TTL.
+        with self._refresh_lock:
+            if self._status_text is None or time.monotonic() - self._status_fetched_at > self.ttl:
+                try:
+                    self._status_text = self._systemctl("status")
+                except RuntimeError as e:
+                    self._status_text = f"Error: {e}"
+                self._status_fetched_at = time.monotonic()
+            return self._status_text
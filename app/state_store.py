@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Shared state for azurednssync.py and the web app in one SQLite database in WAL mode:
+# last-known IPs, per-record sync state, run history, MFA users and small JSON values.
+# Every write is a transaction, so a crash or a concurrent timer run and dashboard request
+# can never leave a torn file behind, and the dashboard's reads never block a sync.
+# Legacy files (last_ip.txt, sync_state.json, run_journal.jsonl, user_mfa.json, ...) are
+# imported once by migrate().
+
+# Where an installed sync keeps the database and the web app reads it from.
+DEFAULT_PATH = "/var/lib/azurednssync2/state.db"
+OUTCOMES = ("unchanged", "updated", "failed", "skipped", "error")
+SCHEMA_VERSION = 1
+BUSY_TIMEOUT_MS = 5000
+RUN_RETENTION_DAYS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS last_ip (
+    record_type TEXT PRIMARY KEY,
+    ip TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS record_state (
+    record_key TEXT PRIMARY KEY,
+    public_ip TEXT,
+    azure_ip TEXT,
+    etag TEXT,
+    verified_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    duration_ms REAL,
+    error TEXT,
+    entry TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_time ON runs (timestamp);
+CREATE INDEX IF NOT EXISTS runs_by_outcome ON runs (outcome, timestamp);
+CREATE TABLE IF NOT EXISTS mfa_users (
+    username TEXT PRIMARY KEY,
+    secret TEXT NOT NULL,
+    enabled INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+class StateStore:
+    def __init__(self, path, run_retention_days=RUN_RETENTION_DAYS):
+        self.path = path
+        self.run_retention_days = run_retention_days
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connection(self):
+        # One connection per thread; autocommit, with explicit transactions below.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            created = not os.path.exists(self.path)
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            if created:
+                # The timer (root) and the web app share the file: group-writable, and the
+                # -wal/-shm files SQLite creates later copy this mode.
+                try:
+                    os.chmod(self.path, 0o660)
+                except OSError:
+                    pass
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            self._local.conn = conn
+            with self._schema_lock:
+                if not self._schema_ready:
+                    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                        conn.executescript(SCHEMA)
+                        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+                    self._schema_ready = True
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so a read-modify-write inside the
+        # block cannot interleave with another process's.
+        conn = self._connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def migrate(self, name, migration):
+        # Runs migration(store) once per database, in the same transaction that marks it done.
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = ?", (f"migrated:{name}",)).fetchone():
+                return False
+            migration(self)
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, '1')", (f"migrated:{name}",))
+            return True
+
+    def get_value(self, key, default=None):
+        row = self._connection().execute("SELECT value FROM meta WHERE key = ?", (f"value:{key}",)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_value(self, key, value):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"value:{key}", json.dumps(value))
+        )
+
+    def last_ips(self):
+        return dict(self._connection().execute("SELECT record_type, ip FROM last_ip"))
+
+    def set_last_ip(self, record_type, ip, updated_at):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO last_ip (record_type, ip, updated_at) VALUES (?, ?, ?)", (record_type, ip, updated_at)
+        )
+
+    def record_states(self):
+        rows = self._connection().execute("SELECT record_key, public_ip, azure_ip, etag, verified_at FROM record_state")
+        return {
+            key: {"public_ip": public_ip, "azure_ip": azure_ip, "etag": etag, "verified_at": verified_at}
+            for key, public_ip, azure_ip, etag, verified_at in rows
+        }
+
+    def replace_record_states(self, records):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM record_state")
+            conn.executemany(
+                "INSERT INTO record_state (record_key, public_ip, azure_ip, etag, verified_at) VALUES (?, ?, ?, ?, ?)",
+                [(key, r.get("public_ip"), r.get("azure_ip"), r.get("etag"), r.get("verified_at", 0)) for key, r in records.items()],
+            )
+
+    def add_run(self, entry):
+        # Runs older than run_retention_days are dropped in the same transaction.
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO runs (timestamp, outcome, duration_ms, error, entry) VALUES (?, ?, ?, ?, ?)",
+                (entry["timestamp"], entry["outcome"], entry.get("duration_ms"), entry.get("error"), json.dumps(entry, separators=(",", ":"))),
+            )
+            if self.run_retention_days:
+                conn.execute("DELETE FROM runs WHERE timestamp < ?", (time.time() - self.run_retention_days * 86400,))
+
+    def query_runs(self, limit=20, offset=0, outcome=None, since=None, until=None):
+        # Newest first. Returns (runs, more) where more says whether older matches exist.
+        where, params = [], []
+        if outcome:
+            where.append("outcome = ?")
+            params.append(outcome)
+        if since is not None:
+            where.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("timestamp < ?")
+            params.append(until)
+        sql = "SELECT entry FROM runs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?"
+        rows = self._connection().execute(sql, params + [limit + 1, offset]).fetchall()
+        return [json.loads(row[0]) for row in rows[:limit]], len(rows) > limit
+
+    def latest_run(self):
+        runs, _ = self.query_runs(limit=1)
+        return runs[0] if runs else None
+
+    def mfa_users(self):
+        rows = self._connection().execute("SELECT username, secret, enabled FROM mfa_users")
+        return {username: {"secret": secret, "enabled": bool(enabled)} for username, secret, enabled in rows}
+
+    def replace_mfa_users(self, users):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM mfa_users")
+            conn.executemany(
+                "INSERT INTO mfa_users (username, secret, enabled) VALUES (?, ?, ?)",
+                [(username, user["secret"], int(bool(user.get("enabled")))) for username, user in users.items()],
+            )
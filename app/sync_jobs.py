@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import uuid
+import threading
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs azurednssync.run_sync() in the web app's process as a background job. There is one
+# worker, so syncs never overlap, and a trigger while a job is queued or running returns
+# that job instead of starting another. The sync module is loaded once, so its cached
+# Azure client, AAD token and DNS cache stay warm between jobs.
+
+SYNC_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "azurednssync.py")
+CONFIG_PATH = "/etc/azurednssync2/config.yaml"
+JOB_HISTORY = 50
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sync-job")
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+_active_job_id = None
+_sync_module = None
+_sync_module_lock = threading.Lock()
+
+def load_sync_module():
+    # Locked: the first fleet report and the first sync job can arrive together, and two
+    # loads would give two copies of the script's clients, breaker and mail worker.
+    global _sync_module
+    with _sync_module_lock:
+        if _sync_module is None:
+            # The script reads the config.yaml and smtp_auth.key the setup and config pages
+            # manage, not copies next to itself. Inherited by the mail drainer it starts.
+            os.environ.setdefault("AZUREDNSSYNC_CONFIG_DIR", os.path.dirname(CONFIG_PATH))
+            spec = importlib.util.spec_from_file_location("azurednssync", SYNC_SCRIPT_PATH)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules["azurednssync"] = module
+            spec.loader.exec_module(module)
+            _sync_module = module
+        return _sync_module
+
+def _run_job(job_id):
+    global _active_job_id
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job["status"] = "running"
+        job["started"] = time.time()
+    try:
+        sync = load_sync_module()
+        entry = sync.run_sync(sync.load_or_create_config())
+        sync.start_mail_drainer()
+        status, outcome, error = "succeeded", entry["outcome"], entry["error"]
+        if outcome in ("failed", "error"):
+            status = "failed"
+    except SystemExit:  # load_or_create_config() exits when there is no usable config
+        status, outcome, error = "failed", "error", f"No usable configuration in {os.environ.get('AZUREDNSSYNC_CONFIG_DIR')}"
+    except Exception as e:
+        status, outcome, error = "failed", "error", str(e) or type(e).__name__
+    with _jobs_lock:
+        job.update(status=status, outcome=outcome, error=error, finished=time.time())
+        _active_job_id = None
+
+def submit_sync_job():
+    # Returns (job, created); created is False when an existing job was reused.
+    global _active_job_id
+    with _jobs_lock:
+        if _active_job_id is not None:
+            return dict(_jobs[_active_job_id]), False
+        job_id = uuid.uuid4().hex[:12]
+        _jobs[job_id] = {
+            "id": job_id,
+            "status": "queued",
+            "submitted": time.time(),
+            "started": None,
+            "finished": None,
+            "outcome": None,
+            "error": None,
+        }
+        while len(_jobs) > JOB_HISTORY:
+            _jobs.popitem(last=False)
+        _active_job_id = job_id
+        job = dict(_jobs[job_id])
+    _executor.submit(_run_job, job_id)
+    return job, True
+
+def get_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
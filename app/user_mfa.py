@@ -1,16 +1,30 @@
 import json
-MFA_PATH = "/opt/azurednssync2/user_mfa.json"
 
-def load_mfa_data():
+try:
+    from .state_store import StateStore, DEFAULT_PATH as STATE_DB_PATH
+except ImportError:  # run.py imports the blueprints as top-level modules
+    from state_store import StateStore, DEFAULT_PATH as STATE_DB_PATH
+
+MFA_PATH = "/opt/azurednssync2/user_mfa.json"  # imported once into the state store
+
+store = StateStore(STATE_DB_PATH)
+
+def import_mfa_file(store):
     try:
         with open(MFA_PATH, "r") as f:
-            return json.load(f)
+            store.replace_mfa_users(json.load(f))
     except FileNotFoundError:
-        return {}
+        pass
+    except Exception as e:
+        print(f"Error importing MFA data: {e}")
+
+def load_mfa_data():
+    try:
+        store.migrate("user_mfa", import_mfa_file)
+        return store.mfa_users()
     except Exception as e:
         print(f"Error loading MFA data: {e}")
         return {}
 
 def save_mfa_data(data):
-    with open(MFA_PATH, "w") as f:
-        json.dump(data, f)
+    store.replace_mfa_users(data)
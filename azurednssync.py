@@ -7,9 +7,95 @@ First Created: 2024-06-01
 Last Updated: 2025-07-17
 
 Synopsis:
-    This script checks your public IP address and updates an Azure DNS A record if it has changed.
+    This script checks your public IP address and updates Azure DNS A/AAAA records if it has changed.
     Designed to be run via systemd timer or manually; no internal scheduling logic.
     Configuration is read from config.yaml and smtp_auth.key, created by install.sh or via --reconfig.
+    Both are parsed through app/config_store.py, shared with the web app: validated once and
+    re-read only when the file changes. Defaults are applied in memory, not written back.
+
+Multiple Records:
+    A single run detects the public IP once and reconciles every configured record set
+    with one shared DnsManagementClient. List them under "zones" in config.yaml:
+
+        zones:
+          - zone_name: example.com
+            resource_group: dns-rg        # optional, defaults to resource_group
+            ttl: 300                      # optional, defaults to ttl
+            record_sets:
+              - home                      # shorthand for an A record
+              - name: home
+                type: AAAA
+              - name: nas                 # prefix + host: nas gets <detected /64>::10
+                type: AAAA
+                ipv6_host: "::10"
+          - zone_name: example.org
+            record_sets:
+              - name: "@"
+                type: A
+
+    If "zones" is empty, the legacy zone_name/record_set_name pair is synced as an A record.
+
+    A and AAAA records are synced by independent pipelines that run concurrently, each with
+    its own address detection, fast path and last committed IP, so a change of one family
+    never reads or writes the other family's records. An AAAA record
+    with "ipv6_host" takes those interface bits within the prefix of the detected IPv6
+    address ("ipv6_prefix_length", default 64, per record, zone or globally), so any number
+    of hosts behind one delegated prefix follow a single detection.
+
+    Every record is read first and the full set of changes is planned before anything is
+    written. Reads and writes run "azure_parallelism" at a time (default 4). Writes carry the
+    etag that was read (If-Match, or If-None-Match for new record sets); a record that was
+    changed concurrently is re-read and retried on its own.
+
+    Zones with 5 or more records to check are read with one paged list call instead of a GET
+    per record ("zone_snapshot": auto, true or false). The snapshot is reused for
+    "zone_snapshot_ttl" seconds (default 300) and patched after every write.
+
+Azure Request Policy:
+    Every ARM call goes through app/request_policy.py. Calls are limited to
+    "azure_requests_per_second" per subscription (default 25, bursts of 250; 0 disables),
+    and the rate is halved on a 429 and recovers gradually. Throttling, 5xx and connection
+    errors are retried up to "azure_max_retries" times (default 4) with jittered exponential
+    backoff, or after the Retry-After the service asks for. After 5 consecutive failed calls
+    (or a Retry-After over 30 s) the circuit opens for 5 minutes: Azure is not called, records
+    last seen in Azure holding the current IP count as in sync, and the rest are retried by
+    the next run once it closes. The circuit state is kept in the state store.
+
+Fast Path:
+    The state store remembers, per record, the public IP, the value and etag last seen in Azure
+    and when it was verified. While the public IP is unchanged and every record was verified
+    less than "verify_interval" seconds ago (default 3600, 0 disables), a run stops after the
+    public IP lookup without contacting Azure or DNS.
+
+Change Debouncing:
+    The state store keeps a short history of detected addresses per family. A changed public IP
+    is written only once it has been seen "change_stable_observations" runs in a row (default
+    1, i.e. at once) or for "change_stable_seconds" (default 0, off); until then the last
+    committed IP stays in Azure and the daemon re-checks every minute. When the address changes
+    "flap_changes" times (default 4) within "flap_window" seconds (default 3600), one event is
+    logged and emailed, and a new address must then hold for "flap_hold" seconds (default 900).
+    "flap_changes: 0" turns flap detection off.
+
+Public IP Detection:
+    Several IP echo providers are queried concurrently: HTTP ("url"), DNS ("name" asked of
+    "server", e.g. myip.opendns.com) and STUN ("server"). "ip_detect_mode: first" takes the
+    first valid answer; "quorum" waits for "ip_quorum" providers to agree. Providers can be
+    set per record type under "ip_providers", e.g. {A: [{type: stun, server: "host:3478"}]}.
+    Latency and error counts per provider are kept in ip_provider_stats.json.
+
+    Hosts that hold the public address themselves, or sit behind a UPnP/NAT-PMP router, can
+    skip the external lookup with "ip_sources", tried in order before any provider:
+        ip_sources:
+          - {type: interface, name: eth0}   # netlink address dump, A and AAAA
+          - {type: natpmp}                  # default gateway, A only
+          - {type: upnp}                    # SSDP + GetExternalIPAddress, A only
+    Only globally routable addresses are accepted; otherwise the providers are used.
+
+DNS Check:
+    Records are resolved in-process (UDP with TCP fallback, A and AAAA, TTL-aware cache).
+    "dns_resolver" selects the servers: "system" (resolv.conf, default), "authoritative"
+    (the zone's Azure name servers, so propagation delays are not mistaken for drift) or
+    a list of server addresses such as ["1.1.1.1", "[2606:4700::1111]:53"].
 
 Manual Run:
     sudo /etc/azurednssync/venv/bin/python /etc/azurednssync/azurednssync.py
@@ -17,6 +103,26 @@ Manual Run:
 Reconfigure:
     sudo /etc/azurednssync/venv/bin/python /etc/azurednssync/azurednssync.py --reconfig
 
+Daemon Mode:
+    sudo /etc/azurednssync/venv/bin/python /etc/azurednssync/azurednssync.py --daemon
+    Runs as a long-lived service instead of a timer. Syncs immediately when netlink reports an
+    address or default-route change, and every "daemon_poll_interval" seconds (default 900)
+    otherwise, keeping the Azure client and token warm between syncs.
+
+Fleet Mode:
+    Many sites can share one controller that holds the Azure credentials: the web app
+    accepts IP reports at POST /fleet/report and writes them from a worker pool (see
+    app/fleet.py). On an edge site, set "fleet_controller" (e.g. https://dns-controller:8443),
+    "fleet_site" and "fleet_token" (and "fleet_ca_file" for a self-signed controller
+    certificate). A run then only detects the public IPs, for the record types under
+    "zones" (A if none), and posts them when they change or verify_interval has passed.
+
+Startup Time:
+    sudo /etc/azurednssync/venv/bin/python /etc/azurednssync/azurednssync.py --profile-startup
+    The Azure SDK, requests, smtplib and cryptography are imported only when a run needs them.
+    This reports per-import time for the "nothing changed" path and exits non-zero if it
+    exceeds the import budget or loads any of those modules.
+
 Dependencies:
     - Python 3.x
     - azure-identity
@@ -24,8 +130,47 @@ Dependencies:
     - requests
     - pyyaml
 
+Logging:
+    Messages are appended to update.log, which is rotated to update.log.<timestamp> once it
+    reaches 5 MB or is a day old. Rotated logs older than 7 days are deleted.
+
+State Store:
+    Last committed IPs, per-record sync state, debounce history, the circuit state and the
+    run history live in one SQLite database in WAL mode ("state_db", default
+    /var/lib/azurednssync2/state.db, or state.db next to the script when that directory does
+    not exist), shared with the web app through app/state_store.py. Every save is one
+    transaction, so a crash mid-run leaves the previous state intact, and the dashboard reads
+    while a sync writes. Each sync records one run (time, phase timings, public IPs,
+    per-record action, outcome, error), indexed by time and outcome for the dashboard's
+    paging and filters; runs older than "run_history_days" (default 30, 0 keeps them all)
+    are deleted as each new one is recorded. If the database stays locked past the busy timeout, the run goes on
+    without it: change debouncing is skipped and the state is not saved.
+
+    On first use the files the store replaced (last_ip.txt, last_ip6.txt, sync_state.json,
+    ip_history.json and "run_journal", default run_journal.jsonl) are imported once and
+    then no longer read.
+
+Notifications:
+    Emails are written to mail_spool/ and sent in the background: by the daemon's mail worker,
+    or by a detached "--drain-mail" process that a one-shot run starts before exiting.
+    Messages due together are sent as one digest; failed sends are retried with backoff
+    (1 minute doubling to 1 hour) and dropped after 7 days.
+
+Metrics:
+    Phase durations (config_load, ip_detect, dns_lookup, azure_read, azure_write, email,
+    total), upstream call and error counts, runs by outcome and the time of the last
+    successful sync are kept in "metrics_state" (default
+    /var/lib/azurednssync2/metrics_state.json, where the web app serves them at /metrics, or
+    metrics_state.json next to the script when that directory does not exist). After every
+    run they are also written in Prometheus text format to "metrics_textfile" (default
+    azurednssync.prom; "" disables) for node_exporter's textfile collector. /metrics needs no
+    login; set METRICS_SCRAPE_TOKEN in the web app's environment to require a bearer token.
+
 Config/Secrets:
-    - Stores config in config.yaml and SMTP credentials in smtp_auth.key (permissions 600).
+    - Stores config in config.yaml and SMTP credentials in smtp_auth.key (permissions 600), in
+      the script's directory or in $AZUREDNSSYNC_CONFIG_DIR if set.
+    - Caches AAD tokens in token_cache.bin (permissions 600), encrypted with a key derived from
+      the certificate. Set "token_cache: false" in config.yaml to disable.
 
 License: MIT
 """
@@ -34,29 +179,184 @@ __version__ = "1.3.0"
 
 import os
 import sys
-import yaml
-import requests
-import subprocess
 import argparse
-from datetime import datetime, timedelta
-import smtplib
-from email.mime.text import MIMEText
-import getpass
-
-try:
-    from azure.identity import CertificateCredential
-    from azure.mgmt.dns import DnsManagementClient
-    from azure.mgmt.dns.models import ARecord, RecordSet
-except ImportError:
-    print("Azure packages not installed! Please run 'pip install azure-identity azure-mgmt-dns'")
-    exit(1)
+from datetime import datetime
+import threading
+import time
+import json
+import base64
+import hashlib
+import re
+import socket
+import struct
+import ipaddress
+import queue
+import copy
+import select
+import errno
+import sqlite3
+
+# Heavy modules (azure.*, requests, smtplib, email.mime, cryptography) are imported inside
+# the functions that need them, so a run that ends at "Nothing to do" never loads them.
+# Check with --profile-startup.
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-CONFIG_FILE = os.path.join(SCRIPT_DIR, "config.yaml")
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "app"))
+from config_store import ConfigStore, SmtpKeyStore
+from metrics import MetricsRegistry, DEFAULT_STATE_PATH as METRICS_DEFAULT_STATE_PATH
+from request_policy import RequestPolicy, CircuitBreaker, CircuitOpenError
+from state_store import StateStore, RUN_RETENTION_DAYS, DEFAULT_PATH as STATE_DB_DEFAULT_PATH
+# config.yaml and smtp_auth.key live next to the script unless AZUREDNSSYNC_CONFIG_DIR says
+# otherwise; the web app sets it to the directory its setup and config pages write to.
+CONFIG_DIR = os.environ.get("AZUREDNSSYNC_CONFIG_DIR") or SCRIPT_DIR
+CONFIG_FILE = os.path.join(CONFIG_DIR, "config.yaml")
 LAST_IP_FILE = os.path.join(SCRIPT_DIR, "last_ip.txt")
 LOG_FILE = os.path.join(SCRIPT_DIR, "update.log")
-SMTP_KEY_FILE = os.path.join(SCRIPT_DIR, "smtp_auth.key")
+SMTP_KEY_FILE = os.path.join(CONFIG_DIR, "smtp_auth.key")
+TOKEN_CACHE_FILE = os.path.join(SCRIPT_DIR, "token_cache.bin")
+SYNC_STATE_FILE = os.path.join(SCRIPT_DIR, "sync_state.json")
+IP_PROVIDER_STATS_FILE = os.path.join(SCRIPT_DIR, "ip_provider_stats.json")
+LAST_IP6_FILE = os.path.join(SCRIPT_DIR, "last_ip6.txt")
+IP_HISTORY_FILE = os.path.join(SCRIPT_DIR, "ip_history.json")
+RUN_JOURNAL_FILE = os.path.join(SCRIPT_DIR, "run_journal.jsonl")
+# The installed data directory, where the web app's /metrics reads it; else the script's.
+if os.path.isdir(os.path.dirname(METRICS_DEFAULT_STATE_PATH)):
+    METRICS_STATE_FILE = METRICS_DEFAULT_STATE_PATH
+else:
+    METRICS_STATE_FILE = os.path.join(SCRIPT_DIR, "metrics_state.json")
+METRICS_TEXTFILE = os.path.join(SCRIPT_DIR, "azurednssync.prom")
 IP_DETECT_URL = "https://api.ipify.org"
+IP6_DETECT_URL = "https://api6.ipify.org"
+
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_ROTATE_INTERVAL = 86400
+LOG_RETENTION_DAYS = 7
+
+_log_lock = threading.Lock()
+_log_started_at = {}
+
+# State lives in state.db (app/state_store.py), in the installed data directory where the
+# dashboard reads it, else next to the script. The files it replaced are imported once and
+# then left alone.
+if os.path.isdir(os.path.dirname(STATE_DB_DEFAULT_PATH)):
+    STATE_DB_FILE = STATE_DB_DEFAULT_PATH
+else:
+    STATE_DB_FILE = os.path.join(SCRIPT_DIR, "state.db")
+_state_stores = {}
+_state_stores_lock = threading.Lock()
+
+DEBOUNCE_RECHECK = 60
+
+MAIL_SPOOL_DIR = os.path.join(SCRIPT_DIR, "mail_spool")
+MAIL_TIMEOUT = 30
+MAIL_RETRY_BASE = 60
+MAIL_RETRY_MAX = 3600
+MAIL_MAX_AGE = 7 * 86400
+MAIL_IDLE_TIMEOUT = 60
+
+TOKEN_REFRESH_MARGIN = 300
+AZURE_CONFLICT_RETRIES = 2
+AZURE_REQUESTS_PER_SECOND = 25
+AZURE_REQUEST_BURST = 250
+AZURE_MAX_RETRIES = 4
+AZURE_BACKOFF_BASE = 0.5
+AZURE_BACKOFF_MAX = 30
+AZURE_BREAKER_THRESHOLD = 5
+AZURE_BREAKER_COOLDOWN = 300
+# Headroom over the 95-145 ms the no-change imports measure, so noise does not trip it.
+STARTUP_IMPORT_BUDGET_MS = 250
+STARTUP_FORBIDDEN_IMPORTS = ("azure", "requests", "smtplib", "email.mime", "cryptography")
+
+RESOLV_CONF = "/etc/resolv.conf"
+DNS_PORT = 53
+DNS_TIMEOUT = 3
+DNS_NEGATIVE_TTL = 60
+DNS_QTYPES = {"A": 1, "NS": 2, "CNAME": 5, "AAAA": 28}
+
+_dns_cache = {}
+_dns_cache_lock = threading.Lock()
+
+IP_DETECT_TIMEOUT = 10
+STUN_MAGIC_COOKIE = 0x2112A442
+DEFAULT_IP_PROVIDERS = {
+    "A": [
+        {"type": "http", "url": IP_DETECT_URL},
+        {"type": "http", "url": "https://ipv4.icanhazip.com"},
+        {"type": "dns", "name": "myip.opendns.com", "server": "208.67.222.222"},
+        {"type": "stun", "server": "stun.l.google.com:19302"},
+    ],
+    "AAAA": [
+        {"type": "http", "url": IP6_DETECT_URL},
+        {"type": "http", "url": "https://ipv6.icanhazip.com"},
+        {"type": "dns", "name": "myip.opendns.com", "server": "2620:119:35::35"},
+        {"type": "stun", "server": "stun.l.google.com:19302"},
+    ],
+}
+
+_ip_provider_stats_lock = threading.Lock()
+
+PROC_NET_ROUTE = "/proc/net/route"
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+DAEMON_SETTLE_TIME = 0.2
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+IFA_F_TEMPORARY = 0x01
+IFA_F_DEPRECATED = 0x20
+IFA_F_TENTATIVE = 0x40
+NATPMP_PORT = 5351
+NATPMP_TIMEOUT = 0.25
+SSDP_ADDRESS = ("239.255.255.250", 1900)
+SSDP_TIMEOUT = 2
+UPNP_WAN_SERVICES = (
+    "urn:schemas-upnp-org:service:WANIPConnection:1",
+    "urn:schemas-upnp-org:service:WANIPConnection:2",
+    "urn:schemas-upnp-org:service:WANPPPConnection:1",
+)
+
+_upnp_control_urls = {}
+
+_dns_clients = {}
+_dns_clients_lock = threading.Lock()
+_azure_policies = {}
+_azure_policies_lock = threading.Lock()
+
+ZONE_SNAPSHOT_MIN_RECORDS = 5
+_zone_snapshots = {}
+_zone_snapshots_lock = threading.Lock()
+_zone_list_locks = {}
+
+RECORD_TYPES = {
+    "A": {
+        "records_attr": "a_records",
+        "address_attr": "ipv4_address",
+        "model": "ARecord",
+        "detect_url": IP_DETECT_URL,
+        "last_ip_file": LAST_IP_FILE,
+        "family": "IPv4",
+    },
+    "AAAA": {
+        "records_attr": "aaaa_records",
+        "address_attr": "ipv6_address",
+        "model": "AaaaRecord",
+        "detect_url": IP6_DETECT_URL,
+        "last_ip_file": LAST_IP6_FILE,
+        "family": "IPv6",
+    },
+}
 
 DEFAULTS = {
     "tenant_id": "",
@@ -72,35 +372,97 @@ DEFAULTS = {
     "smtp_port": 587,
     "smtp_username": "apikey",
     "subscription_id": "",
-    "certificate_password": ""
+    "certificate_password": "",
+    "zones": [],
+    "token_cache": True,
+    "verify_interval": 3600,
+    "dns_resolver": "system",
+    "ip_providers": {},
+    "ip_detect_mode": "first",
+    "ip_quorum": 2,
+    "ip_sources": [],
+    "daemon_poll_interval": 900,
+    "state_db": STATE_DB_FILE,
+    "run_journal": RUN_JOURNAL_FILE,
+    "run_history_days": RUN_RETENTION_DAYS,
+    "azure_parallelism": 4,
+    "zone_snapshot": "auto",
+    "zone_snapshot_ttl": 300,
+    "metrics_state": METRICS_STATE_FILE,
+    "metrics_textfile": METRICS_TEXTFILE,
+    "azure_requests_per_second": AZURE_REQUESTS_PER_SECOND,
+    "azure_max_retries": AZURE_MAX_RETRIES,
+    "ipv6_prefix_length": 64,
+    "change_stable_observations": 1,
+    "change_stable_seconds": 0,
+    "flap_window": 3600,
+    "flap_changes": 4,
+    "flap_hold": 900,
+    "fleet_controller": "",
+    "fleet_site": "",
+    "fleet_token": "",
+    "fleet_ca_file": ""
 }
 
+config_store = ConfigStore(CONFIG_FILE, defaults=DEFAULTS)
+metrics = MetricsRegistry()
+_smtp_key_stores = {}
+
+def log_started_at(path, inode):
+    # Timestamp of the first line, read once per log file (inode) rather than per message.
+    if _log_started_at.get("inode") != inode:
+        try:
+            with open(path, "r") as log:
+                started = datetime.strptime(log.read(19), '%Y-%m-%d %H:%M:%S').timestamp()
+        except (OSError, ValueError):
+            started = None
+        _log_started_at.update(inode=inode, started=started)
+    return _log_started_at["started"]
+
+def prune_rotated_logs():
+    cutoff = time.time() - LOG_RETENTION_DAYS * 86400
+    prefix = os.path.basename(LOG_FILE) + "."
+    for name in os.listdir(os.path.dirname(LOG_FILE)):
+        path = os.path.join(os.path.dirname(LOG_FILE), name)
+        try:
+            if name.startswith(prefix) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def rotate_log_if_needed():
+    try:
+        st = os.stat(LOG_FILE)
+    except FileNotFoundError:
+        return
+    started = log_started_at(LOG_FILE, st.st_ino)
+    if st.st_size < LOG_MAX_BYTES and (started is None or time.time() - started < LOG_ROTATE_INTERVAL):
+        return
+    os.replace(LOG_FILE, f"{LOG_FILE}.{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+    prune_rotated_logs()
+
 def log_update(message):
-    seven_days_ago = datetime.now() - timedelta(days=7)
-    pruned_lines = []
-    if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, "r") as log:
-            for line in log:
-                try:
-                    date_str = line[:19]
-                    log_time = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-                except Exception:
-                    pruned_lines.append(line)
-                    continue
-                if log_time >= seven_days_ago:
-                    pruned_lines.append(line)
-    pruned_lines.append(message + "\n")
-    with open(LOG_FILE, "w") as log:
-        log.writelines(pruned_lines)
+    # Append-only: one O_APPEND write per message, so cost does not grow with the log and a
+    # crash cannot lose earlier lines. The file is rotated by size or age, and rotated files
+    # older than LOG_RETENTION_DAYS are removed when a rotation happens.
+    with _log_lock:
+        try:
+            rotate_log_if_needed()
+            fd = os.open(LOG_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (message + "\n").encode("utf-8", "replace"))
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"{datetime.now()}: Failed to write {LOG_FILE}: {e}")
     print(message)
 
 def prompt_and_store_smtp_key(keyfile_path, defaults):
     print("\n--- SMTP Credentials ---\n")
     smtp_username = input(f"SMTP Username [{defaults.get('smtp_username', 'apikey')}]: ").strip() or defaults.get('smtp_username', 'apikey')
+    import getpass
     smtp_password = getpass.getpass("SMTP API Key or password: ")
-    with open(keyfile_path, "w") as kf:
-        kf.write(f"username:{smtp_username}\npassword:{smtp_password}\n")
-    os.chmod(keyfile_path, 0o600)
+    smtp_key_store(keyfile_path).write(smtp_username, smtp_password)
     print(f"SMTP credentials saved to {keyfile_path} (permissions set to 600)")
 
 def is_interactive():
@@ -119,6 +481,7 @@ def prompt_config(defaults):
     config['record_set_name'] = input(f"Record Set Name [{defaults['record_set_name']}]: ").strip() or defaults['record_set_name']
     config['ttl'] = int(input(f"TTL [{defaults['ttl']}]: ").strip() or defaults['ttl'])
     config['certificate_path'] = input(f"Path to Azure app certificate [{defaults['certificate_path']}]: ").strip() or defaults['certificate_path']
+    import getpass
     config["certificate_password"] = getpass.getpass("Certificate password (if any, else leave blank): ")
 
     print("\nEmail/SMTP Configuration:")
@@ -131,55 +494,223 @@ def prompt_config(defaults):
 
     return config
 
+def smtp_key_store(keyfile_path):
+    if keyfile_path not in _smtp_key_stores:
+        _smtp_key_stores[keyfile_path] = SmtpKeyStore(keyfile_path)
+    return _smtp_key_stores[keyfile_path]
+
 def read_smtp_key(keyfile_path):
-    username = password = None
     try:
-        with open(keyfile_path, "r") as kf:
-            for line in kf:
-                if line.startswith("username:"):
-                    username = line.split(":", 1)[1].strip()
-                elif line.startswith("password:"):
-                    password = line.split(":", 1)[1].strip()
-        return username, password
+        return smtp_key_store(keyfile_path).read()
     except Exception as e:
         log_update(f"{datetime.now()}: Failed to read SMTP key file: {e}")
         return None, None
 
-def send_email(subject, body, config):
-    smtp_username, smtp_password = read_smtp_key(SMTP_KEY_FILE)
-    if not smtp_username or not smtp_password:
-        log_update("SMTP credentials missing; cannot send email.")
-        return
-    try:
+class SmtpSession:
+    # One authenticated SMTP connection, opened on first use and reused for later sends
+    # until it is closed or the server drops it.
+    def __init__(self, config):
+        self.config = config
+        self._server = None
+        self._last_used = 0
+
+    def _connect(self):
+        import smtplib
+        if self._server is not None:
+            return self._server
+        smtp_username, smtp_password = read_smtp_key(SMTP_KEY_FILE)
+        if not smtp_username or not smtp_password:
+            raise ValueError("SMTP credentials missing")
+        server = smtplib.SMTP(self.config.get("smtp_server"), int(self.config.get("smtp_port", 587)), timeout=MAIL_TIMEOUT)
+        try:
+            server.starttls()
+            server.login(smtp_username, smtp_password)
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        return server
+
+    def send(self, subject, body):
+        import smtplib
+        from email.mime.text import MIMEText
         msg = MIMEText(body)
         msg['Subject'] = subject
-        msg['From'] = config.get("email_from")
-        msg['To'] = config.get("email_to")
+        msg['From'] = self.config.get("email_from")
+        msg['To'] = self.config.get("email_to")
+        with metrics.track("smtp", "email"):
+            try:
+                self._connect().sendmail(msg['From'], [msg['To']], msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                self._connect().sendmail(msg['From'], [msg['To']], msg.as_string())
+        self._last_used = time.monotonic()
+        log_update(f"{datetime.now()}: Email sent to {msg['To']}")
 
-        smtp_server = config.get("smtp_server")
-        smtp_port = int(config.get("smtp_port", 587))
+    def close_if_idle(self, idle_seconds):
+        if self._server is not None and time.monotonic() - self._last_used >= idle_seconds:
+            self.close()
 
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(smtp_username, smtp_password)
-        server.sendmail(msg['From'], [msg['To']], msg.as_string())
-        server.quit()
-        log_update(f"{datetime.now()}: Email sent to {msg['To']}")
-    except Exception as e:
-        log_update(f"{datetime.now()}: Failed to send email: {e}")
+    def close(self):
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
+
+def spool_email(subject, body):
+    os.makedirs(MAIL_SPOOL_DIR, mode=0o700, exist_ok=True)
+    now_ts = time.time()
+    name = f"{time.time_ns()}-{os.getpid()}-{threading.get_ident()}.json"
+    message = {"subject": subject, "body": body, "created": now_ts, "attempts": 0, "next_attempt": now_ts}
+    return write_json_atomic(os.path.join(MAIL_SPOOL_DIR, name), message)
+
+def spooled_emails():
+    try:
+        names = sorted(n for n in os.listdir(MAIL_SPOOL_DIR) if n.endswith(".json"))
+    except FileNotFoundError:
+        return []
+    messages = []
+    for name in names:
+        path = os.path.join(MAIL_SPOOL_DIR, name)
+        try:
+            with open(path, "r") as f:
+                messages.append((path, json.load(f)))
+        except (OSError, ValueError):
+            continue
+    return messages
+
+def drain_mail_spool(session):
+    # Sends every due message in the spool as one mail (a digest when there are several)
+    # and deletes them; on failure they are kept and retried with exponential backoff.
+    # Returns the time of the next pending retry, or None when the spool is empty.
+    now_ts = time.time()
+    due = []
+    pending = []
+    for path, message in spooled_emails():
+        if now_ts - message.get("created", now_ts) > MAIL_MAX_AGE:
+            log_update(f"{datetime.now()}: Dropping undeliverable email \"{message.get('subject')}\" after {message.get('attempts')} attempts")
+            os.remove(path)
+        elif message.get("next_attempt", 0) <= now_ts:
+            due.append((path, message))
+        else:
+            pending.append(message["next_attempt"])
+    if due:
+        if len(due) == 1:
+            subject, body = due[0][1]["subject"], due[0][1]["body"]
+        else:
+            subject = f"Azure DNS Updated: {len(due)} notifications"
+            body = "\n\n".join(f"{m['subject']}\n{m['body']}" for _, m in due)
+        try:
+            session.send(subject, body)
+            for path, _ in due:
+                os.remove(path)
+        except Exception as e:
+            session.close()
+            log_update(f"{datetime.now()}: Failed to send email: {e}")
+            for path, message in due:
+                message["attempts"] = message.get("attempts", 0) + 1
+                message["next_attempt"] = now_ts + min(MAIL_RETRY_MAX, MAIL_RETRY_BASE * 2 ** (message["attempts"] - 1))
+                message["last_error"] = str(e)[:200]
+                write_json_atomic(path, message)
+                pending.append(message["next_attempt"])
+    return min(pending) if pending else None
+
+def lock_mail_spool():
+    # Only one drainer at a time; returns the open lock file, or None if another holds it.
+    import fcntl
+    os.makedirs(MAIL_SPOOL_DIR, mode=0o700, exist_ok=True)
+    lock = open(os.path.join(MAIL_SPOOL_DIR, ".lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return lock
+    except OSError:
+        lock.close()
+        return None
+
+def run_mail_drainer(config):
+    # --drain-mail: one pass over the spool, for one-shot runs. Retries that are not due
+    # yet are picked up by the next run.
+    lock = lock_mail_spool()
+    if lock is None:
+        return
+    session = SmtpSession(config)
+    try:
+        drain_mail_spool(session)
+    finally:
+        session.close()
+        lock.close()
+        flush_metrics(config)
+
+def start_mail_drainer():
+    # Hands the spool to a detached process so a slow mail relay does not hold up the run.
+    # Nothing is started while every spooled message is still waiting for its retry.
+    now_ts = time.time()
+    if not any(message.get("next_attempt", 0) <= now_ts for _, message in spooled_emails()):
+        return
+    import subprocess
+    try:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--drain-mail"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        log_update(f"{datetime.now()}: Failed to start mail drainer: {e}")
+
+class MailWorker(threading.Thread):
+    # Daemon-mode drainer: wakes when a message is spooled or a retry falls due, and keeps
+    # its SMTP connection open for MAIL_IDLE_TIMEOUT seconds between sends.
+    def __init__(self, config):
+        super().__init__(name="mail-worker", daemon=True)
+        self.session = SmtpSession(config)
+        self.wake = threading.Event()
+        self.stopping = False
+
+    def run(self):
+        next_retry = None
+        while not self.stopping:
+            timeout = MAIL_IDLE_TIMEOUT if next_retry is None else max(0, min(MAIL_IDLE_TIMEOUT, next_retry - time.time()))
+            self.wake.wait(timeout)
+            self.wake.clear()
+            lock = lock_mail_spool()
+            if lock is not None:
+                try:
+                    next_retry = drain_mail_spool(self.session)
+                except Exception as e:
+                    log_update(f"{datetime.now()}: Mail worker error: {e}")
+                finally:
+                    lock.close()
+                    flush_metrics(self.session.config)
+            self.session.close_if_idle(MAIL_IDLE_TIMEOUT)
+        self.session.close()
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+
+_mail_worker = None
+
+def send_email(subject, body, config):
+    # Queues the message on the spool; delivery happens in the daemon's mail worker or,
+    # for one-shot runs, in a detached --drain-mail process started by main().
+    if not spool_email(subject, body):
+        return
+    if _mail_worker is not None:
+        _mail_worker.session.config = config
+        _mail_worker.wake.set()
 
 def load_or_create_config():
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE) as f:
-            config = yaml.safe_load(f) or {}
-        updated = False
-        for key, default in DEFAULTS.items():
-            if key not in config:
-                config[key] = default
-                updated = True
-        if updated:
-            with open(CONFIG_FILE, "w") as f:
-                yaml.safe_dump(config, f)
+    # A read-only snapshot with DEFAULTS filled in; the file is only re-parsed after it
+    # changes on disk, and is never rewritten by a normal run.
+    try:
+        with metrics.timer("config_load"):
+            config = config_store.snapshot()
+    except (OSError, ValueError) as e:
+        print(f"ERROR: Invalid configuration in {CONFIG_FILE}: {e}")
+        sys.exit(2)
+    if config is not None:
         if not os.path.exists(SMTP_KEY_FILE):
             prompt_and_store_smtp_key(SMTP_KEY_FILE, DEFAULTS)
         return config
@@ -188,130 +719,1421 @@ def load_or_create_config():
             print("ERROR: No configuration found and no interactive terminal detected.")
             print(f"Please run this script in an interactive shell to complete initial setup:\n  sudo python3 {os.path.abspath(__file__)}")
             sys.exit(2)
-        config = prompt_config(DEFAULTS.copy())
-        with open(CONFIG_FILE, "w") as f:
-            yaml.safe_dump(config, f)
-        return config
+        config_store.write(prompt_config(DEFAULTS.copy()))
+        return config_store.snapshot()
+
+def get_record_targets(config):
+    targets = []
+    for zone in config.get("zones") or []:
+        zone_name = zone.get("zone_name", "")
+        resource_group = zone.get("resource_group") or config.get("resource_group", "")
+        zone_ttl = zone.get("ttl", config.get("ttl", 300))
+        for entry in zone.get("record_sets") or []:
+            if isinstance(entry, str):
+                entry = {"name": entry}
+            record_type = str(entry.get("type", "A")).upper()
+            if record_type not in RECORD_TYPES:
+                log_update(f"{datetime.now()}: Skipping {entry.get('name')}.{zone_name}: unsupported record type {record_type}")
+                continue
+            ipv6_host = entry.get("ipv6_host") if record_type == "AAAA" else None
+            if ipv6_host:
+                try:
+                    ipaddress.IPv6Address(ipv6_host)
+                except ValueError:
+                    log_update(f"{datetime.now()}: Skipping {entry.get('name')}.{zone_name}: invalid ipv6_host {ipv6_host}")
+                    continue
+            targets.append(make_record_target(
+                resource_group, zone_name, entry.get("name", ""), record_type, entry.get("ttl", zone_ttl),
+                ipv6_host, entry.get("ipv6_prefix_length", zone.get("ipv6_prefix_length", config.get("ipv6_prefix_length", 64)))
+            ))
+    if not targets and config.get("zone_name") and config.get("record_set_name"):
+        targets.append(make_record_target(
+            config["resource_group"], config["zone_name"], config["record_set_name"], "A", config.get("ttl", 300)
+        ))
+    return targets
+
+def make_record_target(resource_group, zone_name, record_set_name, record_type, ttl, ipv6_host=None, ipv6_prefix_length=64):
+    fqdn = zone_name if record_set_name in ("", "@") else f"{record_set_name}.{zone_name}"
+    target = {
+        "resource_group": resource_group,
+        "zone_name": zone_name,
+        "record_set_name": record_set_name or "@",
+        "record_type": record_type,
+        "ttl": int(ttl),
+        "fqdn": fqdn,
+    }
+    if ipv6_host:
+        target["ipv6_host"] = ipv6_host
+        target["ipv6_prefix_length"] = int(ipv6_prefix_length)
+    return target
+
+def prefix_host_address(public_ip, ipv6_host, prefix_length):
+    # ipv6_host's interface bits within the prefix of the detected address, e.g.
+    # 2001:db8:1:2::abcd with host ::10 and a /64 gives 2001:db8:1:2::10.
+    network = ipaddress.IPv6Network(f"{public_ip}/{prefix_length}", strict=False)
+    host_bits = int(ipaddress.IPv6Address(ipv6_host)) & int(network.hostmask)
+    return str(ipaddress.IPv6Address(int(network.network_address) | host_bits))
+
+def record_target_ip(record, public_ips):
+    # The address a record should hold: the detected one, or for an AAAA record with an
+    # ipv6_host, that host in the detected prefix.
+    public_ip = public_ips.get(record["record_type"])
+    if public_ip and record.get("ipv6_host"):
+        return prefix_host_address(public_ip, record["ipv6_host"], record["ipv6_prefix_length"])
+    return public_ip
 
-def get_public_ip():
+def default_record_target(config):
+    return make_record_target(
+        config["resource_group"], config["zone_name"], config["record_set_name"], "A", config.get("ttl", 300)
+    )
+
+def get_public_ip(url=IP_DETECT_URL):
     try:
-        return requests.get(IP_DETECT_URL, timeout=10).text.strip()
+        return http_get_text(url, timeout=10)
     except Exception as e:
         log_update(f"{datetime.now()}: Failed to detect public IP: {e}")
         return None
 
-def get_dns_record_ip(record_name):
+def encode_dns_name(name):
+    encoded = b""
+    for label in name.rstrip(".").split("."):
+        if label:
+            label_bytes = label.encode("idna")
+            encoded += bytes([len(label_bytes)]) + label_bytes
+    return encoded + b"\0"
+
+def build_dns_query(name, qtype):
+    qid = int.from_bytes(os.urandom(2), "big")
+    header = struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0)
+    return qid, header + encode_dns_name(name) + struct.pack("!HH", DNS_QTYPES[qtype], 1)
+
+def read_dns_name(data, offset):
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated DNS name")
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise ValueError("DNS name compression loop")
+            if offset + 1 >= len(data):
+                raise ValueError("Truncated DNS name")
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            break
+        if offset + length > len(data):
+            raise ValueError("Truncated DNS name")
+        labels.append(data[offset:offset + length].decode("ascii", "replace"))
+        offset += length
+    return ".".join(labels), end if end is not None else offset
+
+def parse_dns_response(data, qid):
+    # Any truncated or garbled packet raises ValueError, so callers can skip it.
+    if len(data) < 12:
+        raise ValueError("Short DNS response")
+    rid, flags, qdcount, ancount, _, _ = struct.unpack("!HHHHHH", data[:12])
+    if rid != qid:
+        raise ValueError("DNS response ID mismatch")
+    offset = 12
+    for _ in range(qdcount):
+        _, offset = read_dns_name(data, offset)
+        offset += 4
+        if offset > len(data):
+            raise ValueError("Truncated DNS question")
+    answers = []
+    for _ in range(ancount):
+        _, offset = read_dns_name(data, offset)
+        if offset + 10 > len(data):
+            raise ValueError("Truncated DNS answer")
+        rtype, _, ttl, rdlength = struct.unpack("!HHIH", data[offset:offset + 10])
+        offset += 10
+        if offset + rdlength > len(data):
+            raise ValueError("Truncated DNS answer")
+        rdata = data[offset:offset + rdlength]
+        if rtype == DNS_QTYPES["A"] and rdlength == 4:
+            value = socket.inet_ntop(socket.AF_INET, rdata)
+        elif rtype == DNS_QTYPES["AAAA"] and rdlength == 16:
+            value = socket.inet_ntop(socket.AF_INET6, rdata)
+        elif rtype in (DNS_QTYPES["NS"], DNS_QTYPES["CNAME"]):
+            value = read_dns_name(data, offset)[0]
+        else:
+            value = None
+        offset += rdlength
+        answers.append((rtype, value, ttl))
+    return flags & 0x000F, bool(flags & 0x0200), answers
+
+def parse_dns_server(server):
+    server = str(server)
+    if server.startswith("["):
+        host, _, port = server[1:].partition("]")
+        return host, int(port.lstrip(":") or DNS_PORT)
+    if server.count(":") == 1:
+        host, port = server.split(":")
+        return host, int(port)
+    return server, DNS_PORT
+
+def recv_exact(sock, length):
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ValueError("DNS TCP connection closed early")
+        data += chunk
+    return data
+
+def dns_query(name, qtype, server, timeout=DNS_TIMEOUT):
+    with metrics.track("dns_query"):
+        return dns_query_uncounted(name, qtype, server, timeout)
+
+def dns_query_uncounted(name, qtype, server, timeout):
+    host, port = parse_dns_server(server)
+    qid, query = build_dns_query(name, qtype)
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect((host, port))
+        sock.send(query)
+        while True:
+            data = sock.recv(4096)
+            try:
+                rcode, truncated, answers = parse_dns_response(data, qid)
+                break
+            except ValueError:
+                continue
+    if truncated:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(struct.pack("!H", len(query)) + query)
+            length = struct.unpack("!H", recv_exact(sock, 2))[0]
+            rcode, _, answers = parse_dns_response(recv_exact(sock, length), qid)
+    return rcode, answers
+
+def resolve_dns(name, qtype, servers):
+    key = (name.lower().rstrip("."), qtype, tuple(servers))
+    with _dns_cache_lock:
+        cached = _dns_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    last_error = None
+    for server in servers:
+        try:
+            rcode, answers = dns_query(name, qtype, server)
+        except (OSError, ValueError) as e:
+            last_error = e
+            continue
+        if rcode not in (0, 3):
+            last_error = ValueError(f"{server} answered with rcode {rcode}")
+            continue
+        values = [value for rtype, value, _ in answers if rtype == DNS_QTYPES[qtype] and value]
+        ttl = min((ttl for _, _, ttl in answers), default=DNS_NEGATIVE_TTL)
+        with _dns_cache_lock:
+            _dns_cache[key] = (time.monotonic() + ttl, values)
+        return values
+    raise last_error or ValueError("No DNS servers available")
+
+def system_nameservers():
+    servers = []
     try:
-        output = subprocess.check_output(
-            ['nslookup', record_name], stderr=subprocess.STDOUT
-        ).decode()
-        lines = output.splitlines()
-        found_question = False
-        for line in lines:
-            if line.strip().startswith('Name:'):
-                found_question = True
-            if found_question and line.strip().startswith('Address:'):
-                ip = line.strip().split('Address:')[1].strip()
-                return ip
-        for line in lines[::-1]:
-            if "Address:" in line:
-                parts = line.split("Address:")
-                if len(parts) > 1:
-                    ip = parts[1].strip()
-                    if "." in ip:
-                        return ip
-        return None
+        with open(RESOLV_CONF, "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == "nameserver":
+                    servers.append(parts[1].split("%")[0])
+    except OSError:
+        pass
+    return servers or ["127.0.0.1"]
+
+def zone_nameservers(zone_name):
+    system_servers = system_nameservers()
+    addresses = []
+    for ns_host in resolve_dns(zone_name, "NS", system_servers):
+        addresses.extend(resolve_dns(ns_host, "A", system_servers))
+    return addresses or system_servers
+
+def dns_servers_for(resolver, zone_name=None):
+    if isinstance(resolver, (list, tuple)):
+        return list(resolver)
+    if resolver == "authoritative" and zone_name:
+        return zone_nameservers(zone_name)
+    return system_nameservers()
+
+def get_dns_record_ip(record_name, record_type="A", zone_name=None, resolver="system"):
+    try:
+        with metrics.timer("dns_lookup"):
+            values = resolve_dns(record_name, record_type, dns_servers_for(resolver, zone_name))
+        return values[0] if values else None
     except Exception as e:
-        log_update(f"{datetime.now()}: Failed to get DNS record IP with nslookup: {e}")
+        log_update(f"{datetime.now()}: Failed to resolve DNS for {record_name}: {e}")
         return None
 
-def get_azure_dns_ip(config):
+def provider_id(provider):
+    return f"{provider['type']}:{provider.get('url') or provider.get('server')}"
+
+def http_get_text(url, timeout=IP_DETECT_TIMEOUT):
+    # urllib rather than requests: this is the only HTTP call on the "nothing changed"
+    # path, and requests costs more to import than the request itself takes.
+    import urllib.request
+    request = urllib.request.Request(url, headers={"User-Agent": f"AzureDNSSync/{__version__}"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read(256).decode("ascii", "replace").strip()
+
+def http_post_json(url, payload, token=None, cafile=None, timeout=IP_DETECT_TIMEOUT):
+    import ssl
+    import urllib.request
+    headers = {"User-Agent": f"AzureDNSSync/{__version__}", "Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(), headers=headers, method="POST")
+    context = ssl.create_default_context(cafile=cafile) if cafile else None
+    with urllib.request.urlopen(request, timeout=timeout, context=context) as response:
+        return json.loads(response.read(4096) or b"{}")
+
+def query_http_provider(provider, record_type):
+    return http_get_text(provider["url"])
+
+def query_dns_provider(provider, record_type):
+    rcode, answers = dns_query(provider["name"], record_type, provider["server"], timeout=IP_DETECT_TIMEOUT)
+    values = [value for rtype, value, _ in answers if rtype == DNS_QTYPES[record_type] and value]
+    if rcode != 0 or not values:
+        raise ValueError(f"no {record_type} answer (rcode {rcode})")
+    return values[0]
+
+def query_stun_provider(provider, record_type):
+    host, port = parse_dns_server(provider["server"])
+    family = socket.AF_INET6 if record_type == "AAAA" else socket.AF_INET
+    address = socket.getaddrinfo(host, port, family, socket.SOCK_DGRAM)[0][4]
+    transaction_id = os.urandom(12)
+    request = struct.pack("!HHI", 0x0001, 0, STUN_MAGIC_COOKIE) + transaction_id
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(IP_DETECT_TIMEOUT)
+        sock.sendto(request, address)
+        while True:
+            data, _ = sock.recvfrom(2048)
+            if len(data) >= 20 and data[8:20] == transaction_id:
+                break
+    msg_type, msg_length = struct.unpack("!HH", data[:4])
+    if msg_type != 0x0101:
+        raise ValueError(f"unexpected STUN response type {msg_type:#06x}")
+    offset = 20
+    mapped = None
+    while offset + 4 <= 20 + msg_length:
+        attr_type, attr_length = struct.unpack("!HH", data[offset:offset + 4])
+        value = data[offset + 4:offset + 4 + attr_length]
+        offset += 4 + attr_length + (-attr_length % 4)
+        if attr_type not in (0x0001, 0x0020) or len(value) < 8:
+            continue
+        addr_bytes = value[4:]
+        if attr_type == 0x0020:
+            mask = struct.pack("!I", STUN_MAGIC_COOKIE) + transaction_id
+            addr_bytes = bytes(b ^ mask[i] for i, b in enumerate(addr_bytes))
+        mapped = socket.inet_ntop(socket.AF_INET6 if value[1] == 0x02 else socket.AF_INET, addr_bytes)
+        if attr_type == 0x0020:
+            break
+    if not mapped:
+        raise ValueError("STUN response had no mapped address")
+    return mapped
+
+IP_PROVIDER_TYPES = {
+    "http": query_http_provider,
+    "dns": query_dns_provider,
+    "stun": query_stun_provider,
+}
+
+def parse_netlink_addr_messages(data):
+    addresses = []
+    done = False
+    offset = 0
+    while offset + 16 <= len(data):
+        length, msg_type, _, _, _ = struct.unpack_from("=IHHII", data, offset)
+        if length < 16:
+            break
+        if msg_type == NLMSG_DONE:
+            done = True
+        elif msg_type == NLMSG_ERROR:
+            error = struct.unpack_from("=i", data, offset + 16)[0]
+            if error:
+                raise OSError(-error, os.strerror(-error))
+            done = True
+        elif msg_type in (RTM_NEWADDR, RTM_DELADDR):
+            family, prefixlen, flags, scope, index = struct.unpack_from("=BBBBI", data, offset + 16)
+            attrs = {}
+            pos = offset + 24
+            end = offset + length
+            while pos + 4 <= end:
+                rta_len, rta_type = struct.unpack_from("=HH", data, pos)
+                if rta_len < 4:
+                    break
+                attrs[rta_type] = data[pos + 4:pos + rta_len]
+                pos += (rta_len + 3) & ~3
+            if IFA_FLAGS in attrs:
+                flags = struct.unpack("=I", attrs[IFA_FLAGS][:4])[0]
+            raw = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+            if raw and family in (socket.AF_INET, socket.AF_INET6):
+                addresses.append({
+                    "event": msg_type,
+                    "index": index,
+                    "family": family,
+                    "address": socket.inet_ntop(family, raw),
+                    "prefixlen": prefixlen,
+                    "scope": scope,
+                    "flags": flags,
+                })
+        offset += (length + 3) & ~3
+    return addresses, done
+
+def netlink_addresses(family=socket.AF_UNSPEC):
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) as sock:
+        sock.settimeout(1)
+        header = struct.pack("=IHHII", 24, RTM_GETADDR, NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+        sock.send(header + struct.pack("=BBBBI", family, 0, 0, 0, 0))
+        addresses = []
+        while True:
+            batch, done = parse_netlink_addr_messages(sock.recv(65536))
+            addresses.extend(batch)
+            if done:
+                return addresses
+
+def is_public_address(ip, record_type):
     try:
-        credential = CertificateCredential(
-            tenant_id=config["tenant_id"],
-            client_id=config["client_id"],
-            certificate_path=config["certificate_path"],
-            password=config["certificate_password"] if config["certificate_password"] else None
-        )
-        dns_client = DnsManagementClient(credential, config["subscription_id"])
-        record_set = dns_client.record_sets.get(
-            resource_group_name=config["resource_group"],
-            zone_name=config["zone_name"],
-            relative_record_set_name=config["record_set_name"],
-            record_type="A",
-        )
-        if record_set.a_records and len(record_set.a_records) > 0:
-            return record_set.a_records[0].ipv4_address
+        parsed = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return parsed.version == (6 if record_type == "AAAA" else 4) and parsed.is_global
+
+def query_interface_source(source, record_type):
+    family = socket.AF_INET6 if record_type == "AAAA" else socket.AF_INET
+    index = socket.if_nametoindex(source["name"])
+    candidates = [
+        a for a in netlink_addresses(family)
+        if a["index"] == index
+        and not a["flags"] & (IFA_F_TENTATIVE | IFA_F_DEPRECATED)
+        and is_public_address(a["address"], record_type)
+    ]
+    # Prefer stable addresses over privacy (temporary) IPv6 addresses.
+    candidates.sort(key=lambda a: bool(a["flags"] & IFA_F_TEMPORARY))
+    return candidates[0]["address"] if candidates else None
+
+def default_gateway():
+    with open(PROC_NET_ROUTE, "r") as f:
+        for line in f.readlines()[1:]:
+            fields = line.split()
+            if len(fields) > 2 and fields[1] == "00000000" and int(fields[3], 16) & 0x2:
+                return socket.inet_ntoa(struct.pack("<I", int(fields[2], 16)))
+    return None
+
+def query_natpmp_source(source, record_type):
+    if record_type != "A":
+        return None
+    gateway = source.get("gateway") or default_gateway()
+    if not gateway:
+        raise ValueError("no default gateway")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect((gateway, int(source.get("port", NATPMP_PORT))))
+        timeout = NATPMP_TIMEOUT
+        for _ in range(3):
+            sock.settimeout(timeout)
+            sock.send(b"\x00\x00")
+            try:
+                data = sock.recv(16)
+            except socket.timeout:
+                timeout *= 2
+                continue
+            if len(data) >= 12 and data[1] == 128:
+                result_code = struct.unpack("!H", data[2:4])[0]
+                if result_code != 0:
+                    raise ValueError(f"NAT-PMP result code {result_code}")
+                return socket.inet_ntoa(data[8:12])
+        raise ValueError(f"no NAT-PMP answer from {gateway}")
+
+def discover_upnp_control_url():
+    from urllib.parse import urljoin
+    import xml.etree.ElementTree as ET
+    search = (
+        "M-SEARCH * HTTP/1.1\r\n"
+        f"HOST: {SSDP_ADDRESS[0]}:{SSDP_ADDRESS[1]}\r\n"
+        'MAN: "ssdp:discover"\r\n'
+        "MX: 1\r\n"
+        "ST: urn:schemas-upnp-org:device:InternetGatewayDevice:1\r\n\r\n"
+    ).encode()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(SSDP_TIMEOUT)
+        sock.sendto(search, SSDP_ADDRESS)
+        data, _ = sock.recvfrom(4096)
+    location = None
+    for line in data.decode("latin-1").split("\r\n"):
+        if line.lower().startswith("location:"):
+            location = line.split(":", 1)[1].strip()
+    if not location:
+        raise ValueError("SSDP response without LOCATION")
+    import requests
+    root = ET.fromstring(requests.get(location, timeout=SSDP_TIMEOUT).content)
+    for service in root.iter():
+        if not service.tag.endswith("service"):
+            continue
+        fields = {child.tag.split("}")[-1]: (child.text or "").strip() for child in service}
+        if fields.get("serviceType") in UPNP_WAN_SERVICES:
+            return urljoin(location, fields["controlURL"]), fields["serviceType"]
+    raise ValueError("no WANIPConnection service on the gateway")
+
+def query_upnp_source(source, record_type):
+    import requests
+    import xml.etree.ElementTree as ET
+    if record_type != "A":
+        return None
+    if source.get("control_url"):
+        control_url = source["control_url"]
+        service_type = source.get("service_type", UPNP_WAN_SERVICES[0])
+    else:
+        if "discovered" not in _upnp_control_urls:
+            _upnp_control_urls["discovered"] = discover_upnp_control_url()
+        control_url, service_type = _upnp_control_urls["discovered"]
+    body = (
+        '<?xml version="1.0"?>'
+        '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+        's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+        f'<u:GetExternalIPAddress xmlns:u="{service_type}"/>'
+        '</s:Body></s:Envelope>'
+    )
+    response = requests.post(control_url, data=body, timeout=SSDP_TIMEOUT, headers={
+        "Content-Type": 'text/xml; charset="utf-8"',
+        "SOAPAction": f'"{service_type}#GetExternalIPAddress"',
+    })
+    response.raise_for_status()
+    for element in ET.fromstring(response.content).iter():
+        if element.tag.split("}")[-1] == "NewExternalIPAddress":
+            return (element.text or "").strip()
+    raise ValueError("GetExternalIPAddress response without an address")
+
+IP_SOURCE_TYPES = {
+    "interface": query_interface_source,
+    "natpmp": query_natpmp_source,
+    "upnp": query_upnp_source,
+}
+
+def detect_local_ip(record_type, config):
+    # Local sources are tried in order before any external provider. A source only
+    # counts when it yields a globally routable address of the right family.
+    for source in config.get("ip_sources") or []:
+        handler = IP_SOURCE_TYPES.get(source.get("type"))
+        if not handler:
+            continue
+        try:
+            with metrics.track(f"ip_source_{source.get('type')}"):
+                ip = handler(source, record_type)
+        except Exception as e:
+            log_update(f"{datetime.now()}: IP source {source.get('type')} failed: {e}")
+            continue
+        if ip and is_public_address(ip, record_type):
+            return ip
+    return None
+
+def load_ip_provider_stats():
+    try:
+        with open(IP_PROVIDER_STATS_FILE, "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def save_ip_provider_stats(stats):
+    with _ip_provider_stats_lock:
+        write_json_atomic(IP_PROVIDER_STATS_FILE, stats)
+
+def record_ip_provider_result(stats, provider, latency, error=None):
+    with _ip_provider_stats_lock:
+        entry = stats.setdefault(provider_id(provider), {"successes": 0, "failures": 0, "avg_latency_ms": None})
+        if error:
+            entry["failures"] += 1
+            entry["last_error"] = str(error)[:200]
         else:
-            return None
+            entry["successes"] += 1
+            latency_ms = round(latency * 1000, 1)
+            previous = entry.get("avg_latency_ms")
+            entry["avg_latency_ms"] = latency_ms if previous is None else round(previous * 0.8 + latency_ms * 0.2, 1)
+        entry["last_used"] = time.time()
+
+def run_ip_provider(provider, record_type, stats):
+    started = time.monotonic()
+    try:
+        ip = IP_PROVIDER_TYPES[provider["type"]](provider, record_type)
+        parsed = ipaddress.ip_address(ip)
+        if parsed.version != (6 if record_type == "AAAA" else 4):
+            raise ValueError(f"returned {ip}, expected {RECORD_TYPES[record_type]['family']}")
+        record_ip_provider_result(stats, provider, time.monotonic() - started)
+        metrics.call(f"ip_{provider['type']}")
+        return str(parsed)
     except Exception as e:
-        log_update(f"{datetime.now()}: Failed to get Azure DNS IP: {e}")
+        record_ip_provider_result(stats, provider, time.monotonic() - started, e)
+        metrics.call(f"ip_{provider['type']}", e)
+        raise
+
+def detect_public_ip(record_type, config, stats=None):
+    # Queries every configured IP echo provider at once. "first" returns the first valid
+    # answer; "quorum" waits until ip_quorum providers agree. Per-provider latency and
+    # error counts are kept in ip_provider_stats.json between runs.
+    local_ip = detect_local_ip(record_type, config)
+    if local_ip:
+        return local_ip
+    providers = (config.get("ip_providers") or {}).get(record_type) or DEFAULT_IP_PROVIDERS[record_type]
+    providers = [p for p in providers if p.get("type") in IP_PROVIDER_TYPES]
+    mode = config.get("ip_detect_mode", "first")
+    quorum = max(1, min(int(config.get("ip_quorum", 2)), len(providers))) if mode == "quorum" else 1
+    # Callers detecting several families at once pass one shared stats dict and save it.
+    owns_stats = stats is None
+    if owns_stats:
+        stats = load_ip_provider_stats()
+    providers.sort(key=lambda p: (stats.get(provider_id(p)) or {}).get("avg_latency_ms") or float("inf"))
+    votes = {}
+    errors = []
+    result = None
+    # Daemon threads rather than an executor: in "first" mode the losers are abandoned,
+    # and a one-shot run must be able to exit without waiting for their timeouts.
+    results = queue.Queue()
+
+    def worker(provider):
+        try:
+            results.put((provider, run_ip_provider(provider, record_type, stats), None))
+        except Exception as e:
+            results.put((provider, None, e))
+
+    for provider in providers:
+        threading.Thread(target=worker, args=(provider,), daemon=True).start()
+    deadline = time.monotonic() + IP_DETECT_TIMEOUT + 1
+    for _ in providers:
+        try:
+            provider, ip, error = results.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            errors.append("remaining providers: timed out")
+            break
+        if error:
+            errors.append(f"{provider_id(provider)}: {error}")
+            continue
+        votes[ip] = votes.get(ip, 0) + 1
+        if votes[ip] >= quorum:
+            result = ip
+            break
+    if result is None:
+        if votes:
+            log_update(f"{datetime.now()}: Public {RECORD_TYPES[record_type]['family']} providers disagree, no quorum of {quorum}: {votes}")
+        for error in errors:
+            log_update(f"{datetime.now()}: Failed to detect public IP via {error}")
+    if owns_stats:
+        save_ip_provider_stats(stats)
+    return result
+
+def certificate_thumbprint(cert_bytes):
+    match = re.search(rb"-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----", cert_bytes, re.S)
+    der = base64.b64decode(b"".join(match.group(1).split())) if match else cert_bytes
+    return hashlib.sha1(der).hexdigest().upper()
+
+class PersistentTokenCache:
+    # Encrypted on-disk AAD token cache for one-shot timer runs. Entries are keyed by
+    # tenant/client/certificate thumbprint/scope; the encryption key is derived from the
+    # certificate file, so only a process that can read the certificate can use the cache.
+    def __init__(self, path, cert_bytes, namespace):
+        from cryptography.fernet import Fernet
+        self.path = path
+        self.namespace = namespace
+        key = hashlib.sha256(b"azurednssync-token-cache\0" + cert_bytes).digest()
+        self._fernet = Fernet(base64.urlsafe_b64encode(key))
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                return json.loads(self._fernet.decrypt(f.read()))
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log_update(f"{datetime.now()}: Ignoring unreadable token cache {self.path}: {e}")
+            return {}
+
+    def get(self, scope_key, min_expires_on):
+        entry = self._load().get(f"{self.namespace}|{scope_key}")
+        if entry and entry["expires_on"] > min_expires_on:
+            return entry
         return None
 
-def get_last_ip():
-    if os.path.exists(LAST_IP_FILE):
-        with open(LAST_IP_FILE, "r") as f:
-            return f.read().strip()
-    return None
+    def put(self, scope_key, token, expires_on):
+        now = time.time()
+        entries = {k: v for k, v in self._load().items() if v.get("expires_on", 0) > now}
+        entries[f"{self.namespace}|{scope_key}"] = {"token": token, "expires_on": expires_on}
+        data = self._fernet.encrypt(json.dumps(entries).encode())
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log_update(f"{datetime.now()}: Failed to write token cache {self.path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+class CachedTokenCredential:
+    # Wraps an azure-identity credential and hands out the same AAD token until it
+    # is within refresh_margin seconds of expiry. Safe to share between threads.
+    # With a PersistentTokenCache, tokens also survive between processes.
+    def __init__(self, credential, refresh_margin=TOKEN_REFRESH_MARGIN, persistent_cache=None):
+        self._credential = credential
+        self._refresh_margin = refresh_margin
+        self._persistent_cache = persistent_cache
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        if kwargs.get("claims"):
+            return self._credential.get_token(*scopes, **kwargs)
+        key = (scopes, tuple(sorted(kwargs.items())))
+        with self._lock:
+            token = self._tokens.get(key)
+            if token is None or token.expires_on - self._refresh_margin <= time.time():
+                token = self._get_fresh_token(scopes, kwargs)
+                self._tokens[key] = token
+            return token
 
-def set_last_ip(ip):
-    with open(LAST_IP_FILE, "w") as f:
-        f.write(ip)
+    def _get_fresh_token(self, scopes, kwargs):
+        from azure.core.credentials import AccessToken
+        scope_key = " ".join(scopes)
+        min_expires_on = time.time() + self._refresh_margin
+        if self._persistent_cache and not kwargs:
+            entry = self._persistent_cache.get(scope_key, min_expires_on)
+            if entry:
+                return AccessToken(entry["token"], int(entry["expires_on"]))
+        token = self._credential.get_token(*scopes, **kwargs)
+        if self._persistent_cache and not kwargs:
+            self._persistent_cache.put(scope_key, token.token, token.expires_on)
+        return token
 
-def update_azure_dns(new_ip, config):
+    def close(self):
+        self._credential.close()
+
+def create_token_cache(config):
+    if not config.get("token_cache", True):
+        return None
     try:
-        credential = CertificateCredential(
-            tenant_id=config["tenant_id"],
-            client_id=config["client_id"],
-            certificate_path=config["certificate_path"],
-            password=config["certificate_password"] if config["certificate_password"] else None
-        )
-        dns_client = DnsManagementClient(credential, config["subscription_id"])
+        with open(config["certificate_path"], "rb") as f:
+            cert_bytes = f.read()
+        namespace = f"{config['tenant_id']}|{config['client_id']}|{certificate_thumbprint(cert_bytes)}"
+        return PersistentTokenCache(TOKEN_CACHE_FILE, cert_bytes, namespace)
+    except Exception as e:
+        log_update(f"{datetime.now()}: Token cache disabled: {e}")
+        return None
+
+def load_azure_sdk():
+    try:
+        from azure.identity import CertificateCredential
+        from azure.mgmt.dns import DnsManagementClient, models
+    except ImportError:
+        print("Azure packages not installed! Please run 'pip install azure-identity azure-mgmt-dns'")
+        sys.exit(1)
+    return CertificateCredential, DnsManagementClient, models
+
+def create_credential(config):
+    CertificateCredential, _, _ = load_azure_sdk()
+    credential = CertificateCredential(
+        tenant_id=config["tenant_id"],
+        client_id=config["client_id"],
+        certificate_path=config["certificate_path"],
+        password=config["certificate_password"] if config["certificate_password"] else None
+    )
+    return CachedTokenCredential(credential, persistent_cache=create_token_cache(config))
+
+def create_dns_client(config):
+    # The SDK's own RetryPolicy is switched off (retry_total=0): RequestPolicy is the only
+    # layer that retries, so it sees every 429 and 5xx and the breaker counts each failure.
+    _, DnsManagementClient, _ = load_azure_sdk()
+    return DnsManagementClient(create_credential(config), config["subscription_id"], retry_total=0)
+
+def client_cache_key(config):
+    return (
+        config["tenant_id"],
+        config["client_id"],
+        config["certificate_path"],
+        config["certificate_password"] or "",
+        config["subscription_id"],
+    )
+
+def get_dns_client(config):
+    # One credential and DnsManagementClient per process and identity, so the AAD token
+    # and the HTTPS connection pool carry over between calls and between syncs.
+    key = client_cache_key(config)
+    with _dns_clients_lock:
+        dns_client = _dns_clients.get(key)
+        if dns_client is None:
+            dns_client = create_dns_client(config)
+            _dns_clients[key] = dns_client
+        return dns_client
+
+def reset_dns_clients():
+    with _dns_clients_lock:
+        clients = list(_dns_clients.values())
+        _dns_clients.clear()
+    for dns_client in clients:
+        try:
+            dns_client.close()
+        except Exception:
+            pass
+
+def record_set_ip(record_set, record_type):
+    spec = RECORD_TYPES[record_type]
+    values = getattr(record_set, spec["records_attr"], None)
+    if values and len(values) > 0:
+        value = getattr(values[0], spec["address_attr"])
         try:
-            record_set = dns_client.record_sets.get(
-                resource_group_name=config["resource_group"],
-                zone_name=config["zone_name"],
-                relative_record_set_name=config["record_set_name"],
-                record_type="A",
+            # Canonical form, so "2001:DB8:0::1" set by hand matches a detected 2001:db8::1.
+            return str(ipaddress.ip_address(value))
+        except ValueError:
+            return value
+    return None
+
+def azure_policy(config):
+    # One request policy (rate limit, retries, circuit breaker) per subscription, shared by
+    # every thread in the process.
+    key = config.get("subscription_id")
+    with _azure_policies_lock:
+        policy = _azure_policies.get(key)
+        if policy is None:
+            policy = RequestPolicy(
+                rate=float(config.get("azure_requests_per_second", AZURE_REQUESTS_PER_SECOND)),
+                burst=AZURE_REQUEST_BURST,
+                max_retries=int(config.get("azure_max_retries", AZURE_MAX_RETRIES)),
+                backoff_base=AZURE_BACKOFF_BASE,
+                backoff_max=AZURE_BACKOFF_MAX,
+                breaker=CircuitBreaker(AZURE_BREAKER_THRESHOLD, AZURE_BREAKER_COOLDOWN),
+                metrics=metrics,
             )
+            _azure_policies[key] = policy
+        return policy
+
+def fetch_record_set(dns_client, record, config):
+    # Returns None when the record set does not exist yet; any other failure is raised.
+    with metrics.track("azure_get", "azure_read"):
+        try:
+            return azure_policy(config).call(lambda: dns_client.record_sets.get(
+                resource_group_name=record["resource_group"],
+                zone_name=record["zone_name"],
+                relative_record_set_name=record["record_set_name"],
+                record_type=record["record_type"],
+            ))
         except Exception as e:
-            log_update(f"{datetime.now()}: Creating new DNS record set: {e}")
-            record_set = RecordSet(ttl=int(config["ttl"]), a_records=[])
-        old_ips = [a.ipv4_address for a in getattr(record_set, "a_records", [])] if hasattr(record_set, "a_records") else []
-        record_set.a_records = [ARecord(ipv4_address=new_ip)]
-        record_set.ttl = int(config["ttl"])
-        dns_client.record_sets.create_or_update(
-            resource_group_name=config["resource_group"],
-            zone_name=config["zone_name"],
-            relative_record_set_name=config["record_set_name"],
-            record_type="A",
-            parameters=record_set
+            if getattr(e, "status_code", None) == 404:
+                return None
+            raise
+
+def zone_snapshot_key(config, record):
+    return (config.get("subscription_id"), record["resource_group"].lower(), record["zone_name"].lower())
+
+def record_set_key(record_type, record_set_name):
+    return (record_type, (record_set_name or "@").lower())
+
+def fetch_zone_snapshot(dns_client, resource_group, zone_name, config):
+    # One paged list call for the whole zone, keyed by record type and relative name.
+    record_sets = {}
+    with metrics.track("azure_list", "azure_read"):
+        listed = azure_policy(config).call(
+            lambda: list(dns_client.record_sets.list_by_dns_zone(resource_group_name=resource_group, zone_name=zone_name))
         )
-        log_update(f"{datetime.now()}: Azure DNS updated from {old_ips[0] if old_ips else '(none)'} to {new_ip}")
+        for record_set in listed:
+            record_type = (record_set.type or "").rsplit("/", 1)[-1].upper()
+            if record_type in RECORD_TYPES:
+                record_sets[record_set_key(record_type, record_set.name)] = record_set
+    return record_sets
+
+def prime_zone_snapshots(records, config, dns_client, zone_records=None):
+    # Loads (or reuses, while younger than zone_snapshot_ttl) a snapshot for each zone of
+    # records that has at least ZONE_SNAPSHOT_MIN_RECORDS records to check, or for every
+    # zone when zone_snapshot is true. Zones without a snapshot fall back to one GET per
+    # record. Records are counted over zone_records (every family's, by default only
+    # records), and a zone being listed for one family is waited for, not listed again.
+    mode = config.get("zone_snapshot", "auto")
+    if mode is False:
+        return
+    sizes = {}
+    for record in zone_records or records:
+        key = zone_snapshot_key(config, record)
+        sizes[key] = sizes.get(key, 0) + 1
+    zones = {}
+    for record in records:
+        zones.setdefault(zone_snapshot_key(config, record), record)
+    max_age = int(config.get("zone_snapshot_ttl", 300))
+    for key, record in zones.items():
+        if mode is not True and sizes.get(key, 0) < ZONE_SNAPSHOT_MIN_RECORDS:
+            continue
+        with _zone_snapshots_lock:
+            list_lock = _zone_list_locks.setdefault(key, threading.Lock())
+        with list_lock:
+            with _zone_snapshots_lock:
+                cached = _zone_snapshots.get(key)
+            if cached and time.monotonic() - cached["fetched_at"] < max_age:
+                continue
+            try:
+                record_sets = fetch_zone_snapshot(dns_client, record["resource_group"], record["zone_name"], config)
+            except Exception as e:
+                log_update(f"{datetime.now()}: Failed to list zone {record['zone_name']}, reading records one by one: {e}")
+                with _zone_snapshots_lock:
+                    _zone_snapshots.pop(key, None)
+                continue
+            with _zone_snapshots_lock:
+                _zone_snapshots[key] = {"fetched_at": time.monotonic(), "record_sets": record_sets}
+
+def read_record_set(dns_client, record, config):
+    # From the zone snapshot when there is one, otherwise a GET.
+    with _zone_snapshots_lock:
+        snapshot = _zone_snapshots.get(zone_snapshot_key(config, record))
+        if snapshot is not None:
+            return snapshot["record_sets"].get(record_set_key(record["record_type"], record["record_set_name"]))
+    return fetch_record_set(dns_client, record, config)
+
+def remember_record_set(config, record, record_set):
+    # Keeps a cached zone snapshot current after a write or re-read of one record.
+    with _zone_snapshots_lock:
+        snapshot = _zone_snapshots.get(zone_snapshot_key(config, record))
+        if snapshot is None:
+            return
+        key = record_set_key(record["record_type"], record["record_set_name"])
+        if record_set is None:
+            snapshot["record_sets"].pop(key, None)
+        else:
+            snapshot["record_sets"][key] = record_set
+
+def get_azure_record_set(config, record=None, dns_client=None):
+    record = record or default_record_target(config)
+    try:
+        return fetch_record_set(dns_client or get_dns_client(config), record, config)
+    except Exception as e:
+        log_update(f"{datetime.now()}: Failed to get Azure DNS IP for {record['fqdn']}: {e}")
+        return None
+
+def get_azure_dns_ip(config, record=None, dns_client=None):
+    record = record or default_record_target(config)
+    record_set = get_azure_record_set(config, record, dns_client)
+    return record_set_ip(record_set, record["record_type"]) if record_set else None
+
+def read_legacy_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        log_update(f"{datetime.now()}: Not importing unreadable {path}: {e}")
+        return None
+
+def migrate_legacy_state(store, config):
+    # One-time import of the files state.db replaced. They are left in place, unread.
+    def last_ips(store):
+        for record_type, spec in RECORD_TYPES.items():
+            try:
+                with open(spec["last_ip_file"], "r") as f:
+                    ip = f.read().strip()
+            except FileNotFoundError:
+                continue
+            if ip:
+                store.set_last_ip(record_type, ip, os.path.getmtime(spec["last_ip_file"]))
+
+    def sync_state(store):
+        state = read_legacy_json(SYNC_STATE_FILE) or {}
+        store.replace_record_states(state.get("records") or {})
+        for key in ("azure_circuit", "fleet"):
+            if state.get(key):
+                store.set_value(key, state[key])
+
+    def ip_history(store):
+        history = read_legacy_json(IP_HISTORY_FILE)
+        if history:
+            store.set_value("ip_history", history)
+
+    def run_journal(store):
+        path = config.get("run_journal") or RUN_JOURNAL_FILE
+        try:
+            with open(path, "r") as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                        store.add_run(entry)
+                    except (ValueError, KeyError):
+                        continue
+        except FileNotFoundError:
+            pass
+
+    migrations = (("last_ip", last_ips), ("sync_state", sync_state), ("ip_history", ip_history), ("run_journal", run_journal))
+    imported = [name for name, migration in migrations if store.migrate(name, migration)]
+    if imported:
+        log_update(f"{datetime.now()}: Imported legacy state ({', '.join(imported)}) into {store.path}")
+
+def state_store(config):
+    # One StateStore per database path; legacy files are imported the first time a process
+    # opens it.
+    path = config.get("state_db") or STATE_DB_FILE
+    with _state_stores_lock:
+        store = _state_stores.get(path)
+        if store is None:
+            store = StateStore(path, int(config.get("run_history_days", RUN_RETENTION_DAYS)))
+            migrate_legacy_state(store, config)
+            _state_stores[path] = store
+        return store
+
+def load_sync_state(config):
+    # Per-record verification state, last committed IPs and small values, read in one go.
+    try:
+        store = state_store(config)
+        with store.transaction():
+            return {
+                "records": store.record_states(),
+                "last_ip": store.last_ips(),
+                "azure_circuit": store.get_value("azure_circuit"),
+                "fleet": store.get_value("fleet"),
+            }
+    except sqlite3.Error as e:
+        log_update(f"{datetime.now()}: Ignoring unreadable sync state {config.get('state_db') or STATE_DB_FILE}: {e}")
+        return {"records": {}, "last_ip": {}}
+
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
         return True
     except Exception as e:
-        log_update(f"{datetime.now()}: Azure DNS update failed: {e}")
+        log_update(f"{datetime.now()}: Failed to write {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+def save_sync_state(config, state):
+    # One transaction: a crash leaves either the previous state or the new one.
+    now_ts = time.time()
+    try:
+        store = state_store(config)
+        with store.transaction():
+            store.replace_record_states(state["records"])
+            for record_type, ip in state.get("last_ip", {}).items():
+                store.set_last_ip(record_type, ip, now_ts)
+            for key in ("azure_circuit", "fleet"):
+                if state.get(key) is not None:
+                    store.set_value(key, state[key])
+    except sqlite3.Error as e:
+        log_update(f"{datetime.now()}: Failed to save sync state: {e}")
+
+def record_state_key(record):
+    return f"{record['record_type']}:{record['resource_group']}/{record['zone_name']}/{record['record_set_name']}"
+
+def mark_record_verified(state, record, public_ip, azure_ip, etag):
+    state["records"][record_state_key(record)] = {
+        "public_ip": public_ip,
+        "azure_ip": azure_ip,
+        "etag": etag,
+        "verified_at": time.time(),
+    }
+
+def records_recently_verified(state, records, public_ips, verify_interval):
+    # True when every record was last seen in Azure holding the current public IP
+    # less than verify_interval seconds ago, so this run needs no Azure or DNS calls.
+    # With public_ips=None, checks only what can be known before IP detection.
+    if verify_interval <= 0:
         return False
+    now_ts = time.time()
+    for record in records:
+        entry = state["records"].get(record_state_key(record))
+        if public_ips is None:
+            # Before the public IP is known: could any IP still make this record pass?
+            if not entry or entry.get("public_ip") != entry.get("azure_ip"):
+                return False
+        else:
+            public_ip = record_target_ip(record, public_ips)
+            if not public_ip:
+                continue
+            if not entry or entry.get("public_ip") != public_ip or entry.get("azure_ip") != public_ip:
+                return False
+        if now_ts - entry.get("verified_at", 0) >= verify_interval:
+            return False
+    return True
+
+def debounce_public_ip(record_type, detected, config, now):
+    # Returns (ip, pending): the IP to sync to, and whether a detected change is still being
+    # held back. A new IP is committed once it has been seen change_stable_observations runs
+    # in a row or for change_stable_seconds. With flap_changes or more changes within
+    # flap_window the address counts as flapping: that is reported once, and a new IP must
+    # then hold for flap_hold seconds before it is written. flap_changes 0 disables this.
+    family = RECORD_TYPES[record_type]["family"]
+    now_ts = time.time()
+    try:
+        store = state_store(config)
+        with store.transaction():
+            history = store.get_value("ip_history", {})
+            entry = history.setdefault(record_type, {"committed": None, "segments": [], "flapping_since": None})
+            committed = entry["committed"]
+            segments = entry["segments"]
+            if committed == detected and segments and segments[-1][0] == detected and not entry["flapping_since"]:
+                return detected, False  # steady state: nothing to record
+            if segments and segments[-1][0] == detected:
+                segments[-1][2] += 1
+            else:
+                segments.append([detected, now_ts, 1])
+            window = int(config.get("flap_window", 3600))
+            while len(segments) > 1 and segments[1][1] < now_ts - window:
+                segments.pop(0)
+            changes = sum(1 for segment in segments[1:] if segment[1] >= now_ts - window)
+            flap_changes = int(config.get("flap_changes", 4))
+            flapping = flap_changes > 0 and changes >= flap_changes
+            if flapping and not entry["flapping_since"]:
+                entry["flapping_since"] = now_ts
+                addresses = ", ".join(dict.fromkeys(segment[0] for segment in segments))
+                message = (f"{now}: Public {family} address is flapping: {changes} changes in the last "
+                           f"{window // 60} minutes between {addresses}. Holding {committed} until it settles.")
+                log_update(message)
+                send_email(subject=f"Azure DNS: public {family} address flapping", body=message, config=config)
+            elif not flapping and entry["flapping_since"]:
+                entry["flapping_since"] = None
+                log_update(f"{now}: Public {family} address has stopped flapping.")
+
+            pending = False
+            if committed is None:
+                entry["committed"] = detected
+            elif detected != committed:
+                _, first_seen, count = segments[-1]
+                held = now_ts - first_seen
+                if entry["flapping_since"]:
+                    stable = held >= int(config.get("flap_hold", 900))
+                else:
+                    stable_seconds = int(config.get("change_stable_seconds", 0))
+                    stable = count >= int(config.get("change_stable_observations", 1)) or (stable_seconds > 0 and held >= stable_seconds)
+                if stable:
+                    entry["committed"] = detected
+                else:
+                    pending = True
+                    log_update(f"{now}: Public {family} address changed to {detected} ({count} observation(s) over {int(held)}s); keeping {committed} until the change holds.")
+            store.set_value("ip_history", history)
+            return entry["committed"], pending
+    except sqlite3.Error as e:
+        # Without the history the detection is used as it is, undebounced.
+        log_update(f"{now}: Could not read or save the public IP history, not debouncing: {e}")
+        return detected, False
+
+def write_record_set(dns_client, record, record_set, new_ip, config):
+    # Conditional write: If-Match on the etag that was read, or If-None-Match: * when the
+    # record set did not exist, so a concurrent change elsewhere fails with 412 instead of
+    # being overwritten. The record set that was read may be the one held in a zone
+    # snapshot, so a copy is changed; the snapshot is only patched from a successful result.
+    spec = RECORD_TYPES[record["record_type"]]
+    _, _, models = load_azure_sdk()
+    if record_set is None:
+        record_set = models.RecordSet(ttl=record["ttl"])
+        conditions = {"if_none_match": "*"}
+    else:
+        conditions = {"if_match": record_set.etag} if getattr(record_set, "etag", None) else {}
+        record_set = copy.copy(record_set)
+    setattr(record_set, spec["records_attr"], [getattr(models, spec["model"])(**{spec["address_attr"]: new_ip})])
+    record_set.ttl = record["ttl"]
+    with metrics.track("azure_put", "azure_write"):
+        return azure_policy(config).call(lambda: dns_client.record_sets.create_or_update(
+            resource_group_name=record["resource_group"],
+            zone_name=record["zone_name"],
+            relative_record_set_name=record["record_set_name"],
+            record_type=record["record_type"],
+            parameters=record_set,
+            **conditions
+        ))
+
+def apply_record_change(change, config, dns_client, now, state):
+    # Writes one planned change. On an etag conflict the record set is read again and only
+    # this record is retried; if someone else already set the public IP, nothing is written.
+    record = change["record"]
+    record_fqdn = record["fqdn"]
+    record_type = record["record_type"]
+    public_ip = change["public_ip"]
+    record_set = change["record_set"]
+    azure_dns_ip = change["azure_ip"]
+    for attempt in range(AZURE_CONFLICT_RETRIES + 1):
+        try:
+            result = write_record_set(dns_client, record, record_set, public_ip, config)
+            break
+        except Exception as e:
+            if getattr(e, "status_code", None) != 412 or attempt == AZURE_CONFLICT_RETRIES:
+                log_update(f"{datetime.now()}: Azure DNS update failed for {record_fqdn}: {e}")
+                log_update(f"{now}: Failed to update DNS for {record_fqdn} to {public_ip}")
+                return False
+            log_update(f"{now}: {record_fqdn} ({record_type}) changed in Azure since it was read; retrying.")
+            try:
+                record_set = fetch_record_set(dns_client, record, config)
+            except Exception as e:
+                log_update(f"{now}: Failed to re-read {record_fqdn} after a conflict: {e}")
+                return False
+            remember_record_set(config, record, record_set)
+            azure_dns_ip = record_set_ip(record_set, record_type) if record_set else None
+            if azure_dns_ip == public_ip:
+                mark_record_verified(state, record, public_ip, azure_dns_ip, getattr(record_set, "etag", None))
+                log_update(f"{now}: {record_fqdn} ({record_type}) already set to {public_ip} by another writer.")
+                return None
+    if result is not None and hasattr(result, "etag"):
+        remember_record_set(config, record, result)
+    mark_record_verified(state, record, public_ip, public_ip, getattr(result, "etag", None))
+    msg = f"{now}: {record_fqdn} ({record_type}) updated in Azure from {azure_dns_ip or '(none)'} to {public_ip}"
+    log_update(msg)
+    return msg
+
+def update_azure_dns(new_ip, config, record=None, dns_client=None):
+    record = record or default_record_target(config)
+    try:
+        dns_client = dns_client or get_dns_client(config)
+        record_set = fetch_record_set(dns_client, record, config)
+    except Exception as e:
+        log_update(f"{datetime.now()}: Azure DNS update failed for {record['fqdn']}: {e}")
+        return False
+    change = {
+        "record": record,
+        "public_ip": new_ip,
+        "record_set": record_set,
+        "azure_ip": record_set_ip(record_set, record["record_type"]) if record_set else None,
+    }
+    return apply_record_change(change, config, dns_client, datetime.now(), {"records": {}})
+
+def read_record_observation(record, config, dns_client):
+    try:
+        return read_record_set(dns_client, record, config), None
+    except Exception as e:
+        return None, e
+
+def observe_records(records, config, dns_client, zone_records=None):
+    # What public DNS and Azure currently hold for each record. DNS lookups and Azure reads
+    # are independent, so both go into one pool, azure_parallelism at a time.
+    from concurrent.futures import ThreadPoolExecutor
+    if not records:
+        return {}
+    if azure_policy(config).breaker.allow():
+        prime_zone_snapshots(records, config, dns_client, zone_records)
+    resolver = config.get("dns_resolver", "system")
+    workers = max(1, min(int(config.get("azure_parallelism", 4)), len(records)))
+    with ThreadPoolExecutor(max_workers=workers * 2) as executor:
+        lookups = [
+            (
+                executor.submit(get_dns_record_ip, r["fqdn"], r["record_type"], r["zone_name"], resolver),
+                executor.submit(read_record_observation, r, config, dns_client),
+            )
+            for r in records
+        ]
+        observations = {}
+        for record, (dns_future, azure_future) in zip(records, lookups):
+            record_set, error = azure_future.result()
+            observations[record_state_key(record)] = {
+                "dns_ip": dns_future.result(),
+                "record_set": record_set,
+                "error": error,
+            }
+    return observations
+
+def plan_record(record, public_ip, observation, now, state):
+    # Returns the change to make for one record, None if it is already in sync, or False
+    # if Azure could not be read.
+    record_fqdn = record["fqdn"]
+    record_type = record["record_type"]
+    dns_ip = observation["dns_ip"]
+    if dns_ip:
+        log_update(f"{now}: Current DNS for {record_fqdn} ({record_type}) resolves to {dns_ip}")
+    else:
+        log_update(f"{now}: Could not resolve DNS for {record_fqdn} ({record_type})")
+
+    cached = state["records"].pop(record_state_key(record), None)
+    if observation["error"]:
+        # Azure could not be read, so what was last seen there still stands.
+        if cached:
+            state["records"][record_state_key(record)] = cached
+        if isinstance(observation["error"], CircuitOpenError) and cached and cached.get("azure_ip") == public_ip:
+            # ARM is failing: go by the last state seen in Azure rather than writing blind.
+            log_update(f"{now}: {observation['error']}; {record_fqdn} ({record_type}) was last seen in Azure holding {public_ip}. Nothing to do.")
+            return None
+        log_update(f"{datetime.now()}: Failed to get Azure DNS IP for {record_fqdn}: {observation['error']}")
+        return False
+    record_set = observation["record_set"]
+    azure_dns_ip = record_set_ip(record_set, record_type) if record_set else None
+    if azure_dns_ip == public_ip:
+        mark_record_verified(state, record, public_ip, azure_dns_ip, getattr(record_set, "etag", None))
+    if azure_dns_ip:
+        log_update(f"{now}: Azure DNS for {record_fqdn} ({record_type}) is set to {azure_dns_ip}")
+    else:
+        log_update(f"{now}: Azure DNS for {record_fqdn} ({record_type}) is not set")
+
+    if public_ip == dns_ip and public_ip == azure_dns_ip:
+        log_update(f"{now}: Public IP, DNS record, and Azure DNS already match for {record_fqdn} ({public_ip}). Nothing to do.")
+        return None
+
+    last_ip = state.get("last_ip", {}).get(record_type)
+    if last_ip:
+        last_ip = record_target_ip(record, {record_type: last_ip})
+    if public_ip == last_ip and public_ip == azure_dns_ip:
+        log_update(f"{now}: IP {public_ip} unchanged since last run and matches Azure, but DNS does not match for {record_fqdn}. Proceeding to update Azure DNS anyway.")
+    else:
+        log_update(f"{now}: IP changed, DNS or Azure out of sync for {record_fqdn}. Updating Azure DNS.")
+    return {"record": record, "public_ip": public_ip, "record_set": record_set, "azure_ip": azure_dns_ip}
+
+def reconcile_records(records, public_ips, config, dns_client, now, state, observations=None):
+    # Plans every record first, then applies only the changes, azure_parallelism at a time.
+    # Observations gathered earlier (while the public IP was being detected) are reused.
+    # Returns (record, result) pairs in record order, where result is the update message,
+    # None (in sync) or False (failed).
+    from concurrent.futures import ThreadPoolExecutor
+    targets = [r for r in records if public_ips.get(r["record_type"])]
+    if not targets:
+        return []
+    if observations is None:
+        observations = observe_records(targets, config, dns_client)
+    plans = [
+        plan_record(r, record_target_ip(r, public_ips), observations[record_state_key(r)], now, state)
+        for r in targets
+    ]
+    changes = [plan for plan in plans if plan]
+    if changes:
+        log_update(f"{now}: {len(changes)} of {len(targets)} record(s) need updating.")
+        workers = max(1, min(int(config.get("azure_parallelism", 4)), len(changes)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            applied = iter(list(executor.map(lambda c: apply_record_change(c, config, dns_client, now, state), changes)))
+    return [(record, next(applied) if plan else plan) for record, plan in zip(targets, plans)]
 
 def run_interactive_setup():
-    defaults = DEFAULTS.copy()
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, "r") as f:
-            existing = yaml.safe_load(f)
-            if existing:
-                defaults.update(existing)
+    defaults = dict(config_store.snapshot() or DEFAULTS)
     if os.path.exists(SMTP_KEY_FILE):
         smtp_user, _ = read_smtp_key(SMTP_KEY_FILE)
         if smtp_user:
             defaults['smtp_username'] = smtp_user
-    config = prompt_config(defaults)
-    with open(CONFIG_FILE, "w") as f:
-        yaml.safe_dump(config, f)
+    config_store.update(prompt_config(defaults))
     print("\nConfiguration complete! All settings saved.\n")
 
+def open_netlink_monitor():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_ROUTE))
+    return sock
+
+def is_relevant_netlink_event(data):
+    # Address changes outside loopback/link-local scope, or any change to a default route.
+    addresses, _ = parse_netlink_addr_messages(data)
+    if any(a["scope"] < 200 for a in addresses):
+        return True
+    offset = 0
+    while offset + 16 <= len(data):
+        length, msg_type, _, _, _ = struct.unpack_from("=IHHII", data, offset)
+        if length < 16:
+            break
+        if msg_type in (RTM_NEWROUTE, RTM_DELROUTE) and length >= 28 and data[offset + 17] == 0:
+            return True
+        offset += (length + 3) & ~3
+    return False
+
+def profile_startup():
+    # Imports the script and everything the "nothing changed" path touches in a fresh
+    # interpreter under -X importtime, then checks the total against STARTUP_IMPORT_BUDGET_MS
+    # and that none of STARTUP_FORBIDDEN_IMPORTS were pulled in. Exit status 1 on failure.
+    import subprocess
+    # Modules the no-change path imports lazily are listed too, so they count against the
+    # budget; tests/test_startup_budget.py runs the path itself.
+    code = f"import sys; sys.path.insert(0, {SCRIPT_DIR!r}); import azurednssync, urllib.request, concurrent.futures, subprocess"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        return 1
+    timings = []
+    loaded = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        loaded.append(name.strip())
+        # Top-level imports only; nested ones are already included in their parent's time.
+        if name.startswith(" ") and not name.startswith("  "):
+            timings.append((int(cumulative) / 1000, name.strip()))
+    total_ms = sum(ms for ms, _ in timings)
+    for ms, name in sorted(timings, reverse=True):
+        print(f"{ms:9.1f} ms  {name}")
+    print(f"{total_ms:9.1f} ms  total (budget {STARTUP_IMPORT_BUDGET_MS} ms)")
+    forbidden = sorted({
+        name for name in loaded
+        if any(name == prefix or name.startswith(prefix + ".") for prefix in STARTUP_FORBIDDEN_IMPORTS)
+    })
+    if forbidden:
+        print(f"Loaded on the no-change path but should be lazy: {', '.join(forbidden)}")
+    return 1 if forbidden or total_ms > STARTUP_IMPORT_BUDGET_MS else 0
+
+def read_netlink_event(monitor):
+    # True if the next message on the monitor socket calls for a sync. ENOBUFS means the
+    # kernel dropped events during a burst, so what changed is unknown: that calls for one
+    # too. Other socket errors are raised.
+    try:
+        return is_relevant_netlink_event(monitor.recv(65536))
+    except OSError as e:
+        if e.errno != errno.ENOBUFS:
+            raise
+        log_update(f"{datetime.now()}: Netlink events were dropped (socket overflow); resyncing.")
+        return True
+
+def run_daemon():
+    # Long-running mode: sync on netlink address/route events (after a short settle time
+    # to absorb bursts) and otherwise every daemon_poll_interval seconds. The DNS client,
+    # AAD token and resolver cache stay warm between syncs.
+    config = load_or_create_config()
+    poll_interval = int(config.get("daemon_poll_interval", 900))
+    try:
+        monitor = open_netlink_monitor()
+    except OSError as e:
+        log_update(f"{datetime.now()}: Netlink monitoring unavailable ({e}); polling every {poll_interval}s only.")
+        monitor = None
+    global _mail_worker
+    _mail_worker = MailWorker(config)
+    _mail_worker.start()
+    _mail_worker.wake.set()
+    log_update(f"{datetime.now()}: AzureDNSSync daemon started (fallback poll every {poll_interval}s).")
+    next_poll = 0
+    try:
+        while True:
+            timeout = max(0, next_poll - time.monotonic())
+            if monitor:
+                readable = select.select([monitor], [], [], timeout)[0]
+            else:
+                time.sleep(timeout)
+                readable = []
+            if readable:
+                try:
+                    if not read_netlink_event(monitor):
+                        continue
+                    settle_until = time.monotonic() + DAEMON_SETTLE_TIME
+                    while select.select([monitor], [], [], max(0, settle_until - time.monotonic()))[0]:
+                        read_netlink_event(monitor)
+                except OSError as e:
+                    log_update(f"{datetime.now()}: Netlink monitoring failed ({e}); polling every {poll_interval}s only.")
+                    monitor.close()
+                    monitor = None
+                else:
+                    log_update(f"{datetime.now()}: Network address change detected.")
+            try:
+                config = load_or_create_config()
+                poll_interval = int(config.get("daemon_poll_interval", 900))
+                entry = run_sync(config)
+            except Exception as e:
+                log_update(f"{datetime.now()}: Sync failed: {e}")
+                entry = {}
+            # A change still being debounced is looked at again soon, not at the next poll.
+            next_poll = time.monotonic() + (min(poll_interval, DEBOUNCE_RECHECK) if entry.get("pending") else poll_interval)
+    except KeyboardInterrupt:
+        log_update(f"{datetime.now()}: AzureDNSSync daemon stopped.")
+    finally:
+        if monitor:
+            monitor.close()
+        _mail_worker.stop()
+        _mail_worker.join(MAIL_TIMEOUT)
+
 def main():
     parser = argparse.ArgumentParser(description="Azure DNS Sync Script")
     parser.add_argument('--reconfig', action='store_true', help='Run interactive configuration')
+    parser.add_argument('--daemon', action='store_true', help='Stay running and sync when network addresses change')
+    parser.add_argument('--drain-mail', action='store_true', help='Send queued notification emails and exit')
+    parser.add_argument('--profile-startup', action='store_true', help='Report per-import startup time against the import budget')
     parser.add_argument('--version', action='version', version=f"%(prog)s {__version__}")
     args = parser.parse_args()
 
@@ -321,47 +2143,246 @@ def main():
         print("Configuration updated successfully!")
         sys.exit(0)
 
-    config = load_or_create_config()
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    public_ip = get_public_ip()
-    if not public_ip:
+    if args.profile_startup:
+        sys.exit(profile_startup())
+
+    if args.daemon:
+        run_daemon()
+        return
+
+    if args.drain_mail:
+        run_mail_drainer(load_or_create_config())
+        return
+
+    run_sync(load_or_create_config())
+    start_mail_drainer()
+
+def run_sync(config):
+    # Every sync leaves one entry in the run history, whatever the outcome, and returns it.
+    entry = {
+        "timestamp": time.time(),
+        "outcome": "unchanged",
+        "phases": {},
+        "public_ips": {},
+        "records": [],
+        "error": None,
+    }
+    started = time.monotonic()
+    try:
+        sync_records(config, entry)
+    except Exception as e:
+        entry["outcome"] = "error"
+        entry["error"] = str(e)
+        raise
+    finally:
+        entry["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+        try:
+            state_store(config).add_run(entry)
+        except sqlite3.Error as e:
+            log_update(f"{datetime.now()}: Failed to record run: {e}")
+        metrics.observe("azurednssync_phase_duration_seconds", entry["duration_ms"] / 1000, phase="total")
+        metrics.inc("azurednssync_sync_runs_total", outcome=entry["outcome"])
+        metrics.set("azurednssync_last_run_timestamp_seconds", entry["timestamp"])
+        if entry["outcome"] in ("unchanged", "updated"):
+            metrics.set("azurednssync_last_success_timestamp_seconds", entry["timestamp"])
+        flush_metrics(config)
+    return entry
+
+def flush_metrics(config):
+    # Merges this process's metrics into the shared state and refreshes the textfile for
+    # node_exporter's textfile collector. Set metrics_textfile to "" to skip the textfile.
+    try:
+        metrics.flush(config.get("metrics_state") or METRICS_STATE_FILE, config.get("metrics_textfile", METRICS_TEXTFILE))
+    except OSError as e:
+        log_update(f"{datetime.now()}: Failed to write metrics: {e}")
+
+def record_phase(entry, phase, started, record_type="A"):
+    # IPv6 pipeline phases are journaled with a "_v6" suffix.
+    if record_type == "AAAA":
+        phase = f"{phase}_v6"
+    entry["phases"][phase] = round((time.monotonic() - started) * 1000, 1)
+
+def connect_and_observe(records, config, entry, record_type="A", zone_records=None):
+    phase_started = time.monotonic()
+    try:
+        dns_client = get_dns_client(config)
+    except Exception as e:
+        log_update(f"{datetime.now()}: Failed to create Azure DNS client: {e}")
+        entry["outcome"] = "failed"
+        entry["error"] = f"Failed to create Azure DNS client: {e}"
+        return None, None
+    record_phase(entry, "azure_client", phase_started, record_type)
+    phase_started = time.monotonic()
+    observations = observe_records(records, config, dns_client, zone_records)
+    record_phase(entry, "observe", phase_started, record_type)
+    return dns_client, observations
+
+def report_to_controller(config, entry, now):
+    # Fleet agent: detect the public IPs and post them to the controller, which holds the
+    # Azure credentials and does the writes. An unchanged IP is re-reported once
+    # verify_interval has passed, as a heartbeat.
+    from concurrent.futures import ThreadPoolExecutor
+    record_types = sorted({r["record_type"] for r in get_record_targets(config)} or {"A"})
+    phase_started = time.monotonic()
+    stats = load_ip_provider_stats()
+    with ThreadPoolExecutor(max_workers=len(record_types)) as executor:
+        public_ips = dict(zip(record_types, executor.map(lambda t: detect_public_ip(t, config, stats), record_types)))
+    save_ip_provider_stats(stats)
+    record_phase(entry, "ip_detect", phase_started)
+    metrics.observe("azurednssync_phase_duration_seconds", time.monotonic() - phase_started, phase="ip_detect")
+    for record_type, public_ip in public_ips.items():
+        if public_ip:
+            public_ips[record_type], pending = debounce_public_ip(record_type, public_ip, config, now)
+            if pending:
+                entry.setdefault("pending", []).append(record_type)
+    entry["public_ips"] = public_ips
+    reported = {record_type: ip for record_type, ip in public_ips.items() if ip}
+    if not reported:
         log_update(f"{now}: Could not retrieve public IP.")
+        entry["outcome"] = "failed"
+        entry["error"] = "Could not retrieve public IP"
         return
 
-    record_fqdn = f"{config['record_set_name']}.{config['zone_name']}"
-    dns_ip = get_dns_record_ip(record_fqdn)
-    if dns_ip:
-        log_update(f"{now}: Current DNS for {record_fqdn} resolves to {dns_ip}")
-    else:
-        log_update(f"{now}: Could not resolve DNS for {record_fqdn}")
+    state = load_sync_state(config)
+    last = state.get("fleet") or {}
+    verify_interval = int(config.get("verify_interval", 3600))
+    if last.get("ips") == reported and time.time() - last.get("reported_at", 0) < verify_interval:
+        log_update(f"{now}: Public IP unchanged and reported within the last {verify_interval}s. Nothing to do.")
+        return
+    phase_started = time.monotonic()
+    url = config["fleet_controller"].rstrip("/") + "/fleet/report"
+    try:
+        with metrics.track("fleet_report", "fleet_report"):
+            http_post_json(url, {"site": config.get("fleet_site"), "ips": reported},
+                           token=config.get("fleet_token"), cafile=config.get("fleet_ca_file") or None)
+    except Exception as e:
+        log_update(f"{now}: Failed to report public IP to {url}: {e}")
+        entry["outcome"] = "failed"
+        entry["error"] = f"Failed to report to fleet controller: {e}"
+        return
+    record_phase(entry, "fleet_report", phase_started)
+    state["fleet"] = {"ips": reported, "reported_at": time.time()}
+    save_sync_state(config, state)
+    if last.get("ips") != reported:
+        log_update(f"{now}: Reported public IP {', '.join(reported.values())} to {url}")
+        entry["outcome"] = "updated"
 
-    azure_dns_ip = get_azure_dns_ip(config)
-    if azure_dns_ip:
-        log_update(f"{now}: Azure DNS for {record_fqdn} is set to {azure_dns_ip}")
-    else:
-        log_update(f"{now}: Azure DNS for {record_fqdn} is not set")
+def sync_family(record_type, records, config, state, entry, stats, now, all_records=None):
+    # One address family end to end. Azure and DNS are read while the public address is
+    # being detected, unless the fast path could still apply, so a run costs about the
+    # slowest of the two rather than their sum. all_records (every family's) decides which
+    # zones are worth a snapshot, which the families then share.
+    from concurrent.futures import ThreadPoolExecutor
+    family = RECORD_TYPES[record_type]["family"]
+    result = {"public_ip": None, "ip_detect": 0, "reconciled": False, "failed": False, "updates": [], "records": []}
+    verify_interval = int(config.get("verify_interval", 3600))
+    prefetch = not records_recently_verified(state, records, None, verify_interval)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        observed = executor.submit(connect_and_observe, records, config, entry, record_type, all_records) if prefetch else None
+        phase_started = time.monotonic()
+        public_ip = detect_public_ip(record_type, config, stats)
+        result["ip_detect"] = time.monotonic() - phase_started
+        record_phase(entry, "ip_detect", phase_started, record_type)
+        if not public_ip:
+            log_update(f"{now}: Could not retrieve public {family} address.")
+            return result
+        public_ip, pending = debounce_public_ip(record_type, public_ip, config, now)
+        result["public_ip"] = public_ip
+        if pending:
+            entry.setdefault("pending", []).append(record_type)
+        public_ips = {record_type: public_ip}
+        if not prefetch and records_recently_verified(state, records, public_ips, verify_interval):
+            log_update(f"{now}: Public {family} address unchanged and Azure DNS verified within the last {verify_interval}s. Nothing to do.")
+            return result
+        if observed is None:
+            observed = executor.submit(connect_and_observe, records, config, entry, record_type, all_records)
+        dns_client, observations = observed.result()
+    if dns_client is None:
+        return result
 
-    if public_ip == dns_ip and public_ip == azure_dns_ip:
-        log_update(f"{now}: Public IP, DNS record, and Azure DNS already match ({public_ip}). Nothing to do.")
+    phase_started = time.monotonic()
+    for record, applied in reconcile_records(records, public_ips, config, dns_client, now, state, observations):
+        if applied:
+            result["updates"].append((record, applied))
+        elif applied is False:
+            result["failed"] = True
+        result["records"].append({
+            "fqdn": record["fqdn"],
+            "type": record_type,
+            "ip": record_target_ip(record, public_ips),
+            "action": "updated" if applied else "failed" if applied is False else "unchanged",
+        })
+    record_phase(entry, "reconcile", phase_started, record_type)
+    result["reconciled"] = True
+    # Tracked per family: an IPv6 change never touches the IPv4 last IP, nor the reverse.
+    if result["updates"] and not result["failed"]:
+        state["last_ip"][record_type] = public_ip
+    return result
+
+def sync_records(config, entry):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if config.get("fleet_controller"):
+        report_to_controller(config, entry, now)
+        return
+    records = get_record_targets(config)
+    if not records:
+        log_update(f"{now}: No DNS records configured. Nothing to do.")
+        entry["outcome"] = "skipped"
         return
 
-    last_ip = get_last_ip()
-    if public_ip == last_ip and public_ip == azure_dns_ip:
-        log_update(f"{now}: IP {public_ip} unchanged since last run and matches Azure, but DNS does not match. Proceeding to update Azure DNS anyway.")
-    else:
-        log_update(f"{now}: IP changed, DNS or Azure out of sync. Updating Azure DNS.")
+    state = load_sync_state(config)
+    breaker = azure_policy(config).breaker
+    breaker.load(state.get("azure_circuit"))
+    families = {}
+    for record in records:
+        families.setdefault(record["record_type"], []).append(record)
+
+    # A and AAAA records are independent pipelines, run side by side: each detects its own
+    # address, has its own fast path and reads and writes only its own records.
+    from concurrent.futures import ThreadPoolExecutor
+    stats = load_ip_provider_stats()
+    with ThreadPoolExecutor(max_workers=len(families)) as executor:
+        results = dict(zip(families, executor.map(
+            lambda record_type: sync_family(record_type, families[record_type], config, state, entry, stats, now, records),
+            families,
+        )))
+    save_ip_provider_stats(stats)
+    metrics.observe("azurednssync_phase_duration_seconds", max(r["ip_detect"] for r in results.values()), phase="ip_detect")
+    public_ips = {record_type: result["public_ip"] for record_type, result in results.items()}
+    entry["public_ips"] = public_ips
+    if not any(public_ips.values()):
+        log_update(f"{now}: Could not retrieve public IP.")
+        entry["outcome"] = "failed"
+        entry["error"] = "Could not retrieve public IP"
+        return
+    if not any(result["reconciled"] for result in results.values()):
+        return
 
-    if update_azure_dns(public_ip, config):
-        msg = f"{now}: {record_fqdn} updated in Azure from {azure_dns_ip or '(none)'} to {public_ip}"
-        log_update(msg)
-        set_last_ip(public_ip)
+    updates = [update for result in results.values() for update in result["updates"]]
+    failed_types = {record_type for record_type, result in results.items() if result["failed"]}
+    for result in results.values():
+        entry["records"].extend(result["records"])
+    state["azure_circuit"] = breaker.dump()
+    save_sync_state(config, state)
+
+    if failed_types:
+        entry["outcome"] = "failed"
+        entry["error"] = entry["error"] or f"Azure DNS update failed for {sum(r['action'] == 'failed' for r in entry['records'])} record(s)"
+    elif updates and entry["outcome"] != "failed":
+        entry["outcome"] = "updated"
+
+    if updates:
+        phase_started = time.monotonic()
+        if len(updates) == 1:
+            subject = f"Azure DNS Updated: {updates[0][0]['fqdn']}"
+        else:
+            subject = f"Azure DNS Updated: {len(updates)} records"
         send_email(
-            subject=f"Azure DNS Updated: {record_fqdn}",
-            body=msg,
+            subject=subject,
+            body="\n".join(msg for _, msg in updates),
             config=config
         )
-    else:
-        log_update(f"{now}: Failed to update DNS to {public_ip}")
+        record_phase(entry, "notify", phase_started)
 
 if __name__ == "__main__":
     main()
@@ -14,7 +14,6 @@ CERT_DIR="$DATA_DIR/certs"
 CERT_NAME="cert"
 CERT_PATH="$CERT_DIR/${CERT_NAME}.pem"
 KEY_PATH="$CERT_DIR/${CERT_NAME}.key"
-MFA_FILE="$DATA_DIR/user_mfa.json"
 LOG_DIR="/var/log/$SERVICE_NAME"
 CONFIG_DIR="/etc/azurednssync2"
 CONFIG_FILE="$CONFIG_DIR/config.yaml"
@@ -48,6 +47,8 @@ echo "Copying application files to $APP_DIR..."
 sudo rsync -a "$TMP_DIR/app/" "$APP_DIR/"
 sudo cp "$TMP_DIR/app/run.py" "$APP_DIR/run.py"
 sudo cp "$TMP_DIR/requirements.txt" "$INSTALL_DIR/requirements.txt"
+# app/sync_jobs.py and app/fleet.py load the sync script from the directory above the app
+sudo cp "$TMP_DIR/azurednssync.py" "$INSTALL_DIR/azurednssync.py"
 [ -d "$TMP_DIR/docs" ] && sudo rsync -a "$TMP_DIR/docs/" "$INSTALL_DIR/docs/"
 [ -d "$TMP_DIR/scripts" ] && sudo rsync -a "$TMP_DIR/scripts/" "$INSTALL_DIR/scripts/"
 
@@ -114,21 +115,30 @@ fi
 echo "Cleaning up temporary directory..."
 rm -rf "$TMP_DIR"
 
-# --- Create persistent MFA data file if it doesn't exist ---
-if [ ! -f "$MFA_FILE" ]; then
-    echo "{}" | sudo tee "$MFA_FILE" > /dev/null
-fi
-
-sudo chown root:$GROUP "$MFA_FILE"
-sudo chmod 660 "$MFA_FILE"
+# --- Persistent state: state.db is written by both the root timer and the web app ---
+# The directory is setgid so new files (state.db-wal, state.db-shm, ...) get the group, and
+# the database is created group-writable; SQLite gives -wal/-shm the database's owner and mode.
 sudo chown root:$GROUP "$DATA_DIR"
-sudo chmod 770 "$DATA_DIR"
-
-# --- Ensure config.yaml exists and is writable by group ---
+sudo chmod 2770 "$DATA_DIR"
+STATE_DB="$DATA_DIR/state.db"
+[ -f "$STATE_DB" ] || sudo touch "$STATE_DB"
+for f in "$STATE_DB" "$STATE_DB-wal" "$STATE_DB-shm"; do
+    if [ -f "$f" ]; then
+        sudo chown root:$GROUP "$f"
+        sudo chmod 660 "$f"
+    fi
+done
+
+# --- Ensure config.yaml exists and the web app can replace it atomically ---
+# Saves write a temp file in the config directory and rename it over config.yaml, keeping
+# its owner and group: the directory is group-writable and setgid, and the file is owned
+# by the service user, which can keep that owner on the new file.
+sudo chown root:$GROUP "$CONFIG_DIR"
+sudo chmod 2775 "$CONFIG_DIR"
 if [ ! -f "$CONFIG_FILE" ]; then
     echo "# AzureDNSSync2 config" | sudo tee "$CONFIG_FILE" > /dev/null
 fi
-sudo chown root:$GROUP "$CONFIG_FILE"
+sudo chown $USER_SERVICE:$GROUP "$CONFIG_FILE"
 sudo chmod 660 "$CONFIG_FILE"
 
 echo "Creating systemd service file..."
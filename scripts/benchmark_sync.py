@@ -0,0 +1,449 @@
+"""
+Benchmark harness for azurednssync.py
+
+Runs the sync CLI's main() against local stand-ins and prints one JSON document with
+latency percentiles, upstream call counts and peak RSS per scenario, for comparing
+versions:
+
+    python scripts/benchmark_sync.py > before.json
+    python scripts/benchmark_sync.py --scenario no_change --iterations 50
+
+Stand-ins:
+    - IP echo service: HTTP server on 127.0.0.1 returning the current "public" IP.
+    - DNS resolver: UDP server on 127.0.0.1 answering A queries from the fake zone.
+    - Azure DNS: in-process record_sets fake (get, list_by_dns_zone, create_or_update with
+      etag preconditions) injected in place of DnsManagementClient.
+    - SMTP: in-process smtplib.SMTP replacement; the spool is drained after the timed runs.
+
+The log_300mb scenario repeats no_change with update.log pre-filled to 300 MB and rotation
+disabled, to show that run time does not grow with the log.
+
+The fleet_reports scenario drives app/fleet.py's controller directly instead of main():
+many sites report their IP each round, a few of them changed, and it measures how fast
+reports are accepted and how long the worker pool takes to write the changes.
+
+Each scenario runs in its own process against a throwaway copy of the script, so module
+caches and peak RSS are per scenario, as they are for a timer-driven run.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import struct
+import argparse
+import tempfile
+import resource
+import threading
+import subprocess
+import importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_PATH = os.path.join(REPO_DIR, "azurednssync.py")
+APP_MODULES = ("config_store.py", "metrics.py", "request_policy.py", "sync_jobs.py", "fleet.py", "state_store.py")
+
+SCENARIOS = {
+    "no_change": {"records": 1, "iterations": 50, "change_ip": False},
+    # no_change against a 300 MB update.log with rotation held off: run time should match
+    # no_change, since logging only ever appends.
+    "log_300mb": {"records": 1, "iterations": 50, "change_ip": False, "prefill_log_mb": 300},
+    "single_change": {"records": 1, "iterations": 20, "change_ip": True},
+    "records_1k": {"records": 1000, "iterations": 5, "change_ip": True},
+    "slow_upstreams": {
+        "records": 3, "iterations": 5, "change_ip": True,
+        "ip_delay": 0.3, "dns_delay": 0.2, "azure_delay": 0.1,
+    },
+    "fleet_reports": {"fleet": True, "sites": 1000, "iterations": 5, "changed_per_round": 50, "azure_delay": 0.02},
+}
+
+class Counters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {}
+
+    def add(self, name, count=1):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + count
+
+class IpEchoServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, counters, delay):
+        self.counters = counters
+        self.delay = delay
+        self.public_ip = "203.0.113.1"
+        super().__init__(("127.0.0.1", 0), IpEchoHandler)
+
+class IpEchoHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.counters.add("ip_echo_requests")
+        time.sleep(self.server.delay)
+        body = self.server.public_ip.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class DnsServer(threading.Thread):
+    # Answers A queries for names in self.answers with TTL 0, NXDOMAIN otherwise.
+    def __init__(self, counters, delay, read_dns_name):
+        super().__init__(daemon=True)
+        self.counters = counters
+        self.delay = delay
+        self.read_dns_name = read_dns_name
+        self.answers = {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+
+    def run(self):
+        while True:
+            data, address = self.sock.recvfrom(512)
+            threading.Thread(target=self.answer, args=(data, address), daemon=True).start()
+
+    def answer(self, data, address):
+        self.counters.add("dns_queries")
+        time.sleep(self.delay)
+        qid = struct.unpack("!H", data[:2])[0]
+        name, offset = self.read_dns_name(data, 12)
+        qtype = struct.unpack("!H", data[offset:offset + 2])[0]
+        question = data[12:offset + 4]
+        ip = self.answers.get(name.lower()) if qtype == 1 else None
+        if ip:
+            header = struct.pack("!HHHHHH", qid, 0x8180, 1, 1, 0, 0)
+            answer = struct.pack("!HHHIH", 0xC00C, 1, 1, 0, 4) + socket.inet_aton(ip)
+        else:
+            header = struct.pack("!HHHHHH", qid, 0x8183, 1, 0, 0, 0)
+            answer = b""
+        self.sock.sendto(header + question + answer, address)
+
+class AzureError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+class FakeRecordSets:
+    def __init__(self, counters, delay):
+        self.counters = counters
+        self.delay = delay
+        self.store = {}
+        self._lock = threading.Lock()
+        self._etag = 0
+
+    def _call(self, name):
+        self.counters.add(f"azure_{name}")
+        time.sleep(self.delay)
+
+    def _record_set(self, name, record_type, entry):
+        records_attr = "a_records" if record_type == "A" else "aaaa_records"
+        address_attr = "ipv4_address" if record_type == "A" else "ipv6_address"
+        return SimpleNamespace(
+            name=name, type=f"Microsoft.Network/dnszones/{record_type}", etag=entry["etag"], ttl=entry["ttl"],
+            **{records_attr: [SimpleNamespace(**{address_attr: ip}) for ip in entry["ips"]]}
+        )
+
+    def get(self, resource_group_name, zone_name, relative_record_set_name, record_type):
+        self._call("get")
+        with self._lock:
+            entry = self.store.get((relative_record_set_name, record_type))
+        if entry is None:
+            raise AzureError(404)
+        return self._record_set(relative_record_set_name, record_type, entry)
+
+    def list_by_dns_zone(self, resource_group_name, zone_name):
+        self._call("list")
+        with self._lock:
+            return [self._record_set(name, record_type, entry) for (name, record_type), entry in self.store.items()]
+
+    def create_or_update(self, resource_group_name, zone_name, relative_record_set_name, record_type, parameters, if_match=None, if_none_match=None):
+        self._call("put")
+        key = (relative_record_set_name, record_type)
+        records = getattr(parameters, "a_records" if record_type == "A" else "aaaa_records") or []
+        ips = [getattr(r, "ipv4_address" if record_type == "A" else "ipv6_address") for r in records]
+        with self._lock:
+            current = self.store.get(key)
+            if (if_none_match == "*" and current) or (if_match and (not current or current["etag"] != if_match)):
+                raise AzureError(412)
+            self._etag += 1
+            self.store[key] = {"ips": ips, "ttl": parameters.ttl, "etag": str(self._etag)}
+            return self._record_set(relative_record_set_name, record_type, self.store[key])
+
+class FakeDnsClient:
+    def __init__(self, record_sets):
+        self.record_sets = record_sets
+
+    def close(self):
+        pass
+
+class FakeSmtp:
+    counters = None
+
+    def __init__(self, host, port, timeout=None):
+        self.counters.add("smtp_connections")
+
+    def starttls(self):
+        pass
+
+    def login(self, username, password):
+        pass
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        self.counters.add("smtp_messages")
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+def fake_models():
+    def model(**fields):
+        return SimpleNamespace(**fields)
+    return SimpleNamespace(
+        RecordSet=lambda ttl: SimpleNamespace(ttl=ttl, etag=None, a_records=None, aaaa_records=None),
+        ARecord=model,
+        AaaaRecord=model,
+    )
+
+def load_script(workdir):
+    # A copy of the script (and the app modules it imports) so every file it writes,
+    # all derived from SCRIPT_DIR, lands in the scenario's scratch directory.
+    os.makedirs(os.path.join(workdir, "app"), exist_ok=True)
+    shutil.copy(SCRIPT_PATH, workdir)
+    for name in APP_MODULES:
+        shutil.copy(os.path.join(REPO_DIR, "app", name), os.path.join(workdir, "app"))
+    spec = importlib.util.spec_from_file_location("azurednssync", os.path.join(workdir, "azurednssync.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["azurednssync"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return round(ordered[index], 2)
+
+def prefill_log(script, megabytes):
+    # Fills update.log with ordinary-looking lines and stops the script from rotating it,
+    # so every timed run appends to a file of that size.
+    script.LOG_MAX_BYTES = float("inf")
+    script.LOG_ROTATE_INTERVAL = float("inf")
+    line = b"2025-01-01 00:00:00: Public IPv4 address unchanged and Azure DNS verified within the last 3600s. Nothing to do.\n"
+    chunk = line * (2 ** 20 // len(line) + 1)
+    with open(script.LOG_FILE, "wb") as f:
+        for _ in range(megabytes):
+            f.write(chunk[:2 ** 20])
+
+def fake_azure(script, counters, delay):
+    record_sets = FakeRecordSets(counters, delay)
+    script.create_dns_client = lambda config: FakeDnsClient(record_sets)
+    try:
+        script.load_azure_sdk()
+    except SystemExit:
+        models = fake_models()
+        script.load_azure_sdk = lambda: (None, None, models)
+    return record_sets
+
+def run_fleet_scenario(name, iterations=None):
+    import smtplib
+    settings = SCENARIOS[name]
+    iterations = iterations or settings["iterations"]
+    counters = Counters()
+    workdir = tempfile.mkdtemp(prefix=f"azurednssync-bench-{name}-")
+    try:
+        script = load_script(workdir)
+        import fleet
+        record_sets = fake_azure(script, counters, settings.get("azure_delay", 0))
+        FakeSmtp.counters = counters
+        smtplib.SMTP = FakeSmtp
+
+        sites = {}
+        for i in range(settings["sites"]):
+            sites[f"site{i}"] = {
+                "token_sha256": fleet.hash_token(f"token{i}"),
+                "zones": [{"zone_name": "bench.example", "record_sets": [f"site{i}"]}],
+            }
+            # Globally routable addresses: the controller rejects documentation ranges.
+            record_sets.store[(f"site{i}", "A")] = {"ips": ["20.0.0.1"], "ttl": 300, "etag": "0"}
+        config = dict(script.DEFAULTS)
+        config.update({
+            "tenant_id": "bench", "client_id": "bench", "subscription_id": "bench",
+            "certificate_path": os.path.join(workdir, "missing.pem"),
+            "resource_group": "bench-rg",
+            "email_from": "bench@example.com", "email_to": "ops@example.com",
+            "smtp_server": "127.0.0.1", "smtp_port": 25,
+            "token_cache": False,
+            "metrics_state": os.path.join(workdir, "metrics_state.json"),
+            "state_db": os.path.join(workdir, "state.db"),
+            "azure_requests_per_second": 0,  # the fake does not throttle; measure the code path
+            "fleet_sites": sites,
+            "fleet_zone_writes_per_second": 100,
+        })
+        script.config_store.write(config)
+        script.smtp_key_store(script.SMTP_KEY_FILE).write("bench", "bench")
+
+        controller = fleet.FleetController(sync=script)
+        report_latencies = []
+        drain_ms = []
+        started_all = time.perf_counter()
+        for round_number in range(iterations + 1):
+            if round_number == 1:  # the first round only learns what Azure holds
+                counters.values.clear()
+                started_all = time.perf_counter()
+            for i in range(settings["sites"]):
+                changed = round_number and i % (settings["sites"] // settings["changed_per_round"]) == round_number % 2
+                ip = f"20.0.{round_number % 250}.1" if changed else record_sets.store[(f"site{i}", "A")]["ips"][0]
+                started = time.perf_counter()
+                controller.report(f"site{i}", f"token{i}", {"A": ip})
+                report_latencies.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            while controller.status()["in_flight"]:
+                time.sleep(0.005)
+            drain_ms.append((time.perf_counter() - started) * 1000)
+        elapsed = time.perf_counter() - started_all
+        script._mail_worker.stop()
+
+        reports = settings["sites"] * iterations
+        return {
+            "iterations": iterations,
+            "sites": settings["sites"],
+            "reports_per_minute": round(reports / elapsed * 60),
+            "report_latency_ms": {
+                "p50": percentile(report_latencies, 0.5),
+                "p99": percentile(report_latencies, 0.99),
+                "max": round(max(report_latencies), 2),
+            },
+            "write_drain_ms": {"p50": percentile(drain_ms, 0.5), "max": round(max(drain_ms), 2)},
+            "controller": controller.status(),
+            "calls_per_round": {k: round(v / iterations, 2) for k, v in sorted(counters.values.items())},
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_scenario(name, iterations=None):
+    import smtplib
+    settings = SCENARIOS[name]
+    if settings.get("fleet"):
+        return run_fleet_scenario(name, iterations)
+    iterations = iterations or settings["iterations"]
+    counters = Counters()
+    workdir = tempfile.mkdtemp(prefix=f"azurednssync-bench-{name}-")
+    try:
+        script = load_script(workdir)
+        if settings.get("prefill_log_mb"):
+            prefill_log(script, settings["prefill_log_mb"])
+
+        echo = IpEchoServer(counters, settings.get("ip_delay", 0))
+        threading.Thread(target=echo.serve_forever, daemon=True).start()
+        dns = DnsServer(counters, settings.get("dns_delay", 0), script.read_dns_name)
+        dns.start()
+        record_sets = fake_azure(script, counters, settings.get("azure_delay", 0))
+        FakeSmtp.counters = counters
+        smtplib.SMTP = FakeSmtp
+        script.start_mail_drainer = lambda: counters.add("mail_drainer_starts")
+
+        names = [f"host{i}" for i in range(settings["records"])]
+        for record_name in names:
+            record_sets.store[(record_name, "A")] = {"ips": [echo.public_ip], "ttl": 300, "etag": "0"}
+            dns.answers[f"{record_name}.bench.example"] = echo.public_ip
+        config = dict(script.DEFAULTS)
+        config.update({
+            "tenant_id": "bench", "client_id": "bench", "subscription_id": "bench",
+            "certificate_path": os.path.join(workdir, "missing.pem"),
+            "resource_group": "bench-rg",
+            "zones": [{"zone_name": "bench.example", "record_sets": names}],
+            "ip_providers": {"A": [{"type": "http", "url": f"http://127.0.0.1:{echo.server_port}/"}]},
+            "dns_resolver": [f"127.0.0.1:{dns.sock.getsockname()[1]}"],
+            "email_from": "bench@example.com", "email_to": "ops@example.com",
+            "smtp_server": "127.0.0.1", "smtp_port": 25,
+            "token_cache": False,
+            "metrics_state": os.path.join(workdir, "metrics_state.json"),
+            "state_db": os.path.join(workdir, "state.db"),
+            "azure_requests_per_second": 0,  # the fake does not throttle; measure the code path
+            "flap_changes": 0,  # the change scenarios move the IP every run; time the write, not the hold
+        })
+        script.config_store.write(config)
+        script.smtp_key_store(script.SMTP_KEY_FILE).write("bench", "bench")
+
+        sys.argv = [os.path.join(workdir, "azurednssync.py")]
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                script.main()  # warm-up: first run verifies every record
+                counters.values.clear()
+                latencies = []
+                for i in range(iterations):
+                    if settings["change_ip"]:
+                        echo.public_ip = f"198.51.100.{i % 250 + 1}"
+                        for record_name in names:
+                            dns.answers[f"{record_name}.bench.example"] = echo.public_ip
+                    started = time.perf_counter()
+                    script.main()
+                    latencies.append((time.perf_counter() - started) * 1000)
+                started = time.perf_counter()
+                script.run_mail_drainer(script.load_or_create_config())
+                mail_drain_ms = (time.perf_counter() - started) * 1000
+            finally:
+                sys.stdout = stdout
+        echo.shutdown()
+
+        result = {
+            "iterations": iterations,
+            "records": settings["records"],
+            "latency_ms": {
+                "p50": percentile(latencies, 0.5),
+                "p90": percentile(latencies, 0.9),
+                "p99": percentile(latencies, 0.99),
+                "max": round(max(latencies), 2),
+                "mean": round(sum(latencies) / len(latencies), 2),
+            },
+            "mail_drain_ms": round(mail_drain_ms, 2),
+            "calls_per_run": {k: round(v / iterations, 2) for k, v in sorted(counters.values.items())},
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        if settings.get("prefill_log_mb"):
+            result["log_mb"] = round(os.path.getsize(script.LOG_FILE) / 2 ** 20, 1)
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark azurednssync.py against local stand-ins")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run (repeatable, default all)")
+    parser.add_argument("--iterations", type=int, help="Timed runs per scenario (default per scenario)")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.scenario[0], args.iterations)))
+        return
+
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        command = [sys.executable, os.path.abspath(__file__), "--child", "--scenario", name]
+        if args.iterations:
+            command += ["--iterations", str(args.iterations)]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            results[name] = {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+            continue
+        results[name] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    with open(SCRIPT_PATH) as f:
+        version = next((line.split('"')[1] for line in f if line.startswith("__version__")), None)
+    print(json.dumps({
+        "version": version,
+        "python": sys.version.split()[0],
+        "timestamp": time.time(),
+        "scenarios": results,
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
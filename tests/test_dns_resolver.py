@@ -0,0 +1,137 @@
+import os
+import sys
+import socket
+import struct
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import azurednssync as sync
+
+# The in-process resolver against a stub DNS server on 127.0.0.1 (UDP and TCP on the same
+# port). The stub answers from self.records and can misbehave on request.
+
+class StubDnsServer:
+    def __init__(self):
+        self.records = {}           # (name, qtype) -> [address, ...]
+        self.ttl = 300
+        self.truncate_udp = False   # answer UDP with TC set and no answers
+        self.garbage_first = False  # send an unparseable UDP packet before the answer
+        self.tcp_garbage = False    # answer TCP with a packet cut off mid-answer
+        self.queries = 0
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", 0))
+        self.port = self.udp.getsockname()[1]
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(("127.0.0.1", self.port))
+        self.tcp.listen()
+        threading.Thread(target=self._serve_udp, daemon=True).start()
+        threading.Thread(target=self._serve_tcp, daemon=True).start()
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.port}"
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+    def response(self, query, truncated=False):
+        qid = struct.unpack("!H", query[:2])[0]
+        name, offset = sync.read_dns_name(query, 12)
+        qtype = struct.unpack("!H", query[offset:offset + 2])[0]
+        question = query[12:offset + 4]
+        addresses = [] if truncated else self.records.get((name.lower(), qtype), [])
+        flags = 0x8180 | (0x0200 if truncated else 0) | (0 if addresses or truncated else 3)
+        answers = b""
+        for address in addresses:
+            family = socket.AF_INET6 if qtype == sync.DNS_QTYPES["AAAA"] else socket.AF_INET
+            rdata = socket.inet_pton(family, address)
+            answers += struct.pack("!HHHIH", 0xC00C, qtype, 1, self.ttl, len(rdata)) + rdata
+        return struct.pack("!HHHHHH", qid, flags, 1, len(addresses), 0, 0) + question + answers
+
+    def _serve_udp(self):
+        while True:
+            try:
+                query, client = self.udp.recvfrom(512)
+            except OSError:
+                return
+            self.queries += 1
+            if self.garbage_first:
+                self.udp.sendto(query[:2] + b"\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00", client)
+            self.udp.sendto(self.response(query, truncated=self.truncate_udp), client)
+
+    def _serve_tcp(self):
+        while True:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            with conn:
+                length = struct.unpack("!H", sync.recv_exact(conn, 2))[0]
+                answer = self.response(sync.recv_exact(conn, length))
+                if self.tcp_garbage:
+                    answer = answer[:-3]
+                conn.sendall(struct.pack("!H", len(answer)) + answer)
+
+@pytest.fixture
+def stub():
+    server = StubDnsServer()
+    yield server
+    server.close()
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    sync._dns_cache.clear()
+    yield
+    sync._dns_cache.clear()
+
+def test_resolves_a_over_udp(stub):
+    stub.records[("home.example.com", 1)] = ["20.0.0.1"]
+    assert sync.resolve_dns("home.example.com", "A", [stub.address]) == ["20.0.0.1"]
+
+def test_resolves_aaaa(stub):
+    stub.records[("home.example.com", 28)] = ["2001:db8::10"]
+    assert sync.resolve_dns("home.example.com", "AAAA", [stub.address]) == ["2001:db8::10"]
+
+def test_nxdomain_is_an_empty_answer(stub):
+    assert sync.resolve_dns("missing.example.com", "A", [stub.address]) == []
+
+def test_truncated_udp_answer_retries_over_tcp(stub):
+    stub.records[("home.example.com", 1)] = ["20.0.0.1", "20.0.0.2"]
+    stub.truncate_udp = True
+    assert sync.resolve_dns("home.example.com", "A", [stub.address]) == ["20.0.0.1", "20.0.0.2"]
+
+def test_answers_are_cached_for_their_ttl(stub):
+    stub.records[("home.example.com", 1)] = ["20.0.0.1"]
+    sync.resolve_dns("home.example.com", "A", [stub.address])
+    stub.records[("home.example.com", 1)] = ["20.0.0.2"]
+    assert sync.resolve_dns("home.example.com", "A", [stub.address]) == ["20.0.0.1"]
+    assert stub.queries == 1
+
+def test_malformed_udp_packet_is_skipped(stub):
+    stub.records[("home.example.com", 1)] = ["20.0.0.1"]
+    stub.garbage_first = True
+    assert sync.resolve_dns("home.example.com", "A", [stub.address]) == ["20.0.0.1"]
+
+def test_malformed_answer_falls_back_to_next_server(stub):
+    broken = StubDnsServer()
+    try:
+        broken.records[("home.example.com", 1)] = ["20.0.0.9"]
+        broken.truncate_udp = True
+        broken.tcp_garbage = True
+        stub.records[("home.example.com", 1)] = ["20.0.0.1"]
+        assert sync.resolve_dns("home.example.com", "A", [broken.address, stub.address]) == ["20.0.0.1"]
+    finally:
+        broken.close()
+
+@pytest.mark.parametrize("cut", [11, 20, 30, 40, 45])
+def test_parser_rejects_truncated_packets(stub, cut):
+    stub.records[("home.example.com", 1)] = ["20.0.0.1"]
+    qid, query = sync.build_dns_query("home.example.com", "A")
+    packet = stub.response(query)
+    assert sync.parse_dns_response(packet, qid)[2]
+    with pytest.raises(ValueError):
+        sync.parse_dns_response(packet[:cut], qid)
@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "app"))
+import azurednssync as sync
+from state_store import StateStore
+
+# A timer run whose public IP is unchanged and whose record was verified recently must end
+# at "Nothing to do" without loading the Azure SDK, requests, smtplib or email.mime, and
+# fast. main() runs in a fresh interpreter against a stub IP echo service and a pre-verified
+# state, from a copy of the script so every file it writes lands in tmp_path.
+
+# Wall time of the whole run (interpreter start excluded), with headroom over
+# STARTUP_IMPORT_BUDGET_MS for slow or busy machines.
+RUN_BUDGET_MS = 2 * sync.STARTUP_IMPORT_BUDGET_MS
+PUBLIC_IP = "20.0.0.1"
+
+CHILD = """
+import sys, time, json
+started = time.perf_counter()
+sys.argv = [sys.argv[1]]
+sys.path.insert(0, sys.argv[0].rsplit("/", 1)[0])
+import azurednssync
+azurednssync.main()
+elapsed_ms = (time.perf_counter() - started) * 1000
+print(json.dumps({"elapsed_ms": elapsed_ms, "modules": sorted(sys.modules)}))
+"""
+
+class EchoHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = PUBLIC_IP.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def echo():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+
+def install_copy(tmp_path, echo_url):
+    shutil.copy(os.path.join(REPO_DIR, "azurednssync.py"), tmp_path)
+    shutil.copytree(os.path.join(REPO_DIR, "app"), tmp_path / "app", ignore=shutil.ignore_patterns("__pycache__"))
+    config = {
+        "tenant_id": "t", "client_id": "c", "subscription_id": "s",
+        "certificate_path": str(tmp_path / "cert.pem"),
+        "resource_group": "rg", "zone_name": "example.com", "record_set_name": "home",
+        "email_from": "sync@example.com", "email_to": "ops@example.com",
+        "ip_providers": {"A": [{"type": "http", "url": echo_url}]},
+        "state_db": str(tmp_path / "state.db"),
+        "metrics_state": str(tmp_path / "metrics_state.json"),
+        "metrics_textfile": "",
+    }
+    (tmp_path / "config.yaml").write_text(json.dumps(config))  # JSON is valid YAML
+    (tmp_path / "smtp_auth.key").write_text("username:u\npassword:p\n")
+    store = StateStore(config["state_db"])
+    with store.transaction():
+        store.replace_record_states({
+            "A:rg/example.com/home": {"public_ip": PUBLIC_IP, "azure_ip": PUBLIC_IP, "etag": "1", "verified_at": time.time()},
+        })
+        store.set_last_ip("A", PUBLIC_IP, time.time())
+        store.set_value("ip_history", {"A": {"committed": PUBLIC_IP, "segments": [[PUBLIC_IP, time.time(), 1]], "flapping_since": None}})
+    # Migrations are marked done so the timed run only does what a steady-state run does.
+    for name in ("last_ip", "sync_state", "ip_history", "run_journal"):
+        store.migrate(name, lambda store: None)
+    return tmp_path / "azurednssync.py"
+
+def run_no_change(tmp_path, echo_url):
+    script = install_copy(tmp_path, echo_url)
+    env = dict(os.environ, AZUREDNSSYNC_CONFIG_DIR=str(tmp_path))
+    result = subprocess.run([sys.executable, "-c", CHILD, str(script)], capture_output=True, text=True, env=env, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert "Nothing to do" in (tmp_path / "update.log").read_text()
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_no_change_path_skips_heavy_imports(tmp_path, echo):
+    modules = run_no_change(tmp_path, echo)["modules"]
+    loaded = [
+        name for name in modules
+        if any(name == prefix or name.startswith(prefix + ".") for prefix in sync.STARTUP_FORBIDDEN_IMPORTS)
+    ]
+    assert loaded == []
+
+def test_no_change_path_stays_within_budget(tmp_path, echo):
+    # Best of three, so one scheduling hiccup does not fail the test.
+    timings = []
+    for attempt in range(3):
+        workdir = tmp_path / str(attempt)
+        workdir.mkdir()
+        timings.append(run_no_change(workdir, echo)["elapsed_ms"])
+    assert min(timings) < RUN_BUDGET_MS, timings